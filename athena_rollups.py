@@ -0,0 +1,576 @@
+#!/bin/python3
+"""
+Materialized rollup tables and query library for the VPC FlowLogs parquet lake
+
+Analyst queries (top talkers, rejected connections by port, bytes per ENI per hour)
+are defined once as parameterised SQL and run against small hourly/daily rollup
+tables instead of full scans of the raw flow logs.
+
+Rollups are kept up to date incrementally: processed partitions are recorded per rollup
+in the rollup_progress table and every run only aggregates hours that are not yet
+processed (INSERT INTO, one query per day of hourly partitions).  Hours that may still
+receive data from Firehose (buffer interval + settle time) are skipped until the next
+run.  Hours without a raw partition are re-checked on every run and only recorded as
+empty once they are older than REGISTER_LOOKBACK_DAYS; an empty hour whose partition
+shows up later (e.g. backfilled) is still rolled up.  Daily rollups fold in the hours
+of a day once all 24 hours are processed or empty, hours rolled up later are added to
+the day.
+
+Hours that already had data when they were rolled up are not scanned again.  After a
+backfill (flowlogs_backfill.py) and the crawler run, reprocess the backfilled dates:
+the rollup rows of those days are deleted and rebuilt by update.  Run reprocess again
+if it is interrupted.
+
+Steps (update)
+1.  Create rollup and progress tables if missing (CTAS into partitioned Parquet)
+2.  Register new raw partitions from the Firehose prefixes of the last days
+3.  Aggregate closed, not yet processed hours into the hourly rollup tables
+4.  Aggregate the hours of complete days into the daily rollup tables
+5.  Record processed and empty partitions in the progress table
+
+Engines
+  Athena - raw table created by the glue crawler, rollups written to s3://bucket/rollups/
+  DuckDB - local stand-in over a directory of hive partitioned parquet files
+           (partition_0=YYYY/partition_1=MM/partition_2=DD/partition_3=HH/*.parquet)
+           for testing the rollup logic without an AWS account.
+
+usage:
+  athena_rollups.py [profile_name] [region_name] [database_name] [source_table] [s3bucket_name] [command] [args]
+  athena_rollups.py local [parquet_dir] [duckdb_file] [command] [args]
+
+commands:
+  create
+  update
+  reprocess [start_date YYYY-MM-DD] [end_date YYYY-MM-DD]
+  query [query_name] [start_date YYYY-MM-DD] [end_date YYYY-MM-DD] [limit]
+"""
+
+import sys
+import time
+import datetime
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+# Partition columns of the crawled raw table (Firehose YYYY/MM/DD/HH prefix)
+SOURCE_PARTITIONS = ['partition_0', 'partition_1', 'partition_2', 'partition_3']
+HOURLY_PARTITIONS = ['year', 'month', 'day', 'hour']
+DAILY_PARTITIONS = ['year', 'month', 'day']
+
+# Firehose buffers up to 300 seconds, so an hour is only complete some time after it ends
+SETTLE_MINUTES = 15
+
+# Raw partitions registered by update, days back from today.  Hours without data are
+# only recorded as empty once they are older than this.
+REGISTER_LOOKBACK_DAYS = 2
+
+ROLLUP_PREFIX = 'rollups/'
+PROGRESS_TABLE = 'rollup_progress'
+# Time (epoch ms) of the last progress rows written by this process
+last_progress_time = 0
+ATHENA_RESULTS_PREFIX = 'athena-results/'
+
+# Rollup definitions, in dependency order.
+# {source} is the table rolled up, {where} restricts it to the partitions being processed.
+# Partition columns must come last in the select list.
+ROLLUPS = [
+    {
+        'name': 'talkers_hourly',
+        'source': None,
+        'partitions': HOURLY_PARTITIONS,
+        'select': """SELECT srcaddr, dstaddr,
+       CAST(SUM(bytes) AS BIGINT) AS bytes,
+       CAST(SUM(packets) AS BIGINT) AS packets,
+       CAST(COUNT(*) AS BIGINT) AS flows,
+       partition_0 AS year, partition_1 AS month, partition_2 AS day, partition_3 AS hour
+FROM {source}
+WHERE {where}
+GROUP BY srcaddr, dstaddr, partition_0, partition_1, partition_2, partition_3""",
+    },
+    {
+        'name': 'rejects_hourly',
+        'source': None,
+        'partitions': HOURLY_PARTITIONS,
+        'select': """SELECT dstport, protocol,
+       CAST(COUNT(*) AS BIGINT) AS flows,
+       CAST(SUM(packets) AS BIGINT) AS packets,
+       CAST(COUNT(DISTINCT srcaddr) AS BIGINT) AS sources,
+       partition_0 AS year, partition_1 AS month, partition_2 AS day, partition_3 AS hour
+FROM {source}
+WHERE action = 'REJECT' AND ({where})
+GROUP BY dstport, protocol, partition_0, partition_1, partition_2, partition_3""",
+    },
+    {
+        'name': 'eni_bytes_hourly',
+        'source': None,
+        'partitions': HOURLY_PARTITIONS,
+        'select': """SELECT interface_id,
+       CAST(SUM(bytes) AS BIGINT) AS bytes,
+       CAST(SUM(packets) AS BIGINT) AS packets,
+       CAST(COUNT(*) AS BIGINT) AS flows,
+       partition_0 AS year, partition_1 AS month, partition_2 AS day, partition_3 AS hour
+FROM {source}
+WHERE {where}
+GROUP BY interface_id, partition_0, partition_1, partition_2, partition_3""",
+    },
+    {
+        'name': 'talkers_daily',
+        'source': 'talkers_hourly',
+        'partitions': DAILY_PARTITIONS,
+        'select': """SELECT srcaddr, dstaddr,
+       CAST(SUM(bytes) AS BIGINT) AS bytes,
+       CAST(SUM(packets) AS BIGINT) AS packets,
+       CAST(SUM(flows) AS BIGINT) AS flows,
+       year, month, day
+FROM {source}
+WHERE {where}
+GROUP BY srcaddr, dstaddr, year, month, day""",
+    },
+    {
+        'name': 'rejects_daily',
+        'source': 'rejects_hourly',
+        'partitions': DAILY_PARTITIONS,
+        'select': """SELECT dstport, protocol,
+       CAST(SUM(flows) AS BIGINT) AS flows,
+       CAST(SUM(packets) AS BIGINT) AS packets,
+       year, month, day
+FROM {source}
+WHERE {where}
+GROUP BY dstport, protocol, year, month, day""",
+    },
+]
+
+# Parameterised analyst queries, run against the rollup tables.
+# Parameters: start_date, end_date (YYYY-MM-DD), limit
+QUERIES = {
+    'top_talkers': """SELECT srcaddr, dstaddr, SUM(bytes) AS bytes, SUM(packets) AS packets, SUM(flows) AS flows
+FROM "talkers_daily"
+WHERE year || month || day BETWEEN '{start}' AND '{end}'
+GROUP BY srcaddr, dstaddr
+ORDER BY bytes DESC
+LIMIT {limit}""",
+    'rejected_by_port': """SELECT dstport, protocol, SUM(flows) AS flows, SUM(packets) AS packets
+FROM "rejects_daily"
+WHERE year || month || day BETWEEN '{start}' AND '{end}'
+GROUP BY dstport, protocol
+ORDER BY flows DESC
+LIMIT {limit}""",
+    'bytes_per_eni_hourly': """SELECT interface_id, year, month, day, hour, bytes, packets, flows
+FROM "eni_bytes_hourly"
+WHERE year || month || day BETWEEN '{start}' AND '{end}'
+ORDER BY year, month, day, hour, bytes DESC
+LIMIT {limit}""",
+}
+
+
+class AthenaEngine:
+    # Runs rollup SQL on Athena; partitions are read from the Glue Data Catalog.
+    def __init__(self, athena_client, glue_client, s3_client, database_name, source_table, s3bucket_name):
+        self.athena_client = athena_client
+        self.glue_client = glue_client
+        self.s3_client = s3_client
+        self.database_name = database_name
+        self.source_table = source_table
+        self.s3bucket_name = s3bucket_name
+        self.output_location = 's3://' + s3bucket_name + '/' + ATHENA_RESULTS_PREFIX
+        self.rollup_location = 's3://' + s3bucket_name + '/' + ROLLUP_PREFIX
+
+    # Run a query, wait for it to finish and return (columns, rows)
+    def execute(self, sql) -> tuple:
+        response = self.athena_client.start_query_execution(
+            QueryString=sql,
+            QueryExecutionContext={
+                'Database': self.database_name
+            },
+            ResultConfiguration={
+                'OutputLocation': self.output_location
+            },
+        )
+        query_id = response['QueryExecutionId']
+        while True:
+            response = self.athena_client.get_query_execution(QueryExecutionId=query_id)
+            status = response['QueryExecution']['Status']
+            if status['State'] in ('SUCCEEDED', 'FAILED', 'CANCELLED'):
+                break
+            time.sleep(2)
+        if status['State'] != 'SUCCEEDED':
+            raise Exception("Athena query {0} {1}: {2}".format(
+                query_id, status['State'], status.get('StateChangeReason', '')))
+        columns = []
+        rows = []
+        paginator = self.athena_client.get_paginator('get_query_results')
+        for page in paginator.paginate(QueryExecutionId=query_id):
+            columns = [x['Name'] for x in page['ResultSet']['ResultSetMetadata']['ColumnInfo']]
+            for row in page['ResultSet']['Rows']:
+                values = [x.get('VarCharValue') for x in row['Data']]
+                # the first row of a SELECT result holds the column names
+                if not rows and values == columns:
+                    continue
+                rows.append(tuple(values))
+        return columns, rows
+
+    def source(self, name) -> str:
+        return quote(self.source_table if name is None else name)
+
+    def table_exists(self, table) -> bool:
+        try:
+            self.glue_client.get_table(DatabaseName=self.database_name, Name=table)
+        except self.glue_client.exceptions.EntityNotFoundException:
+            return False
+        return True
+
+    # Returns set of partition value tuples registered for table
+    def partitions(self, table, columns) -> set:
+        partitions = set()
+        paginator = self.glue_client.get_paginator('get_partitions')
+        for page in paginator.paginate(DatabaseName=self.database_name, TableName=table):
+            for partition in page['Partitions']:
+                partitions.add(tuple(partition['Values'][:len(columns)]))
+        return partitions
+
+    # Add raw table partitions for the Firehose YYYY/MM/DD/HH/ prefixes of the last days,
+    # so updates do not depend on the daily crawler run.  Returns number of partitions added.
+    def register_partitions(self, now, days=None) -> int:
+        if days is None:
+            days = REGISTER_LOOKBACK_DAYS
+        registered = self.partitions(self.source_table, SOURCE_PARTITIONS)
+        found = []
+        for i in range(days, -1, -1):
+            prefix = (now - datetime.timedelta(days=i)).strftime('%Y/%m/%d/')
+            paginator = self.s3_client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.s3bucket_name, Prefix=prefix, Delimiter='/'):
+                for common_prefix in page.get('CommonPrefixes', []):
+                    values = tuple(common_prefix['Prefix'].rstrip('/').split('/'))
+                    if values not in registered:
+                        found.append(values)
+        # Athena accepts many partitions per ALTER TABLE, keep statements small
+        for i in range(0, len(found), 24):
+            self.execute("ALTER TABLE {0} ADD IF NOT EXISTS\n{1}".format(
+                quote_ddl(self.source_table),
+                '\n'.join("PARTITION ({0}) LOCATION 's3://{1}/{2}/'".format(
+                    ', '.join("{0} = '{1}'".format(column, value) for column, value in zip(SOURCE_PARTITIONS, values)),
+                    self.s3bucket_name, '/'.join(values)) for values in found[i:i + 24])))
+        return len(found)
+
+    # Delete the rollup files of partitions, the partitions stay registered
+    def delete_partitions(self, table, columns, partitions):
+        for values in partitions:
+            prefix = ROLLUP_PREFIX + table + '/' + ''.join(
+                "{0}={1}/".format(column, value) for column, value in zip(columns, values))
+            paginator = self.s3_client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(Bucket=self.s3bucket_name, Prefix=prefix):
+                keys = [{'Key': x['Key']} for x in page.get('Contents', [])]
+                if keys:
+                    self.s3_client.delete_objects(Bucket=self.s3bucket_name, Delete={'Objects': keys})
+
+    def create_progress_table(self):
+        self.execute("""CREATE EXTERNAL TABLE {0} (rollup_name string, part string, state string, updated bigint)
+STORED AS PARQUET
+LOCATION '{1}'""".format(quote_ddl(PROGRESS_TABLE), self.rollup_location + PROGRESS_TABLE + '/'))
+
+    # CTAS into partitioned Parquet, without data
+    def create_table(self, table, select_sql, partitions):
+        sql = """CREATE TABLE {0}
+WITH (
+  format = 'PARQUET',
+  parquet_compression = 'SNAPPY',
+  external_location = '{1}',
+  partitioned_by = ARRAY[{2}]
+) AS
+{3}
+WITH NO DATA""".format(
+            quote(table),
+            self.rollup_location + table + '/',
+            ', '.join("'{0}'".format(x) for x in partitions),
+            select_sql,
+        )
+        self.execute(sql)
+
+
+class DuckDBEngine:
+    # Local stand-in for Athena over hive partitioned parquet files.
+    # Rollup tables are kept in the DuckDB database file so that updates are incremental.
+    def __init__(self, parquet_dir, database_file=':memory:'):
+        import duckdb
+        self.source_table = 'flowlogs_raw'
+        self.connection = duckdb.connect(database_file)
+        self.connection.execute(
+            "CREATE OR REPLACE VIEW flowlogs_raw AS SELECT * FROM read_parquet('{0}', "
+            "hive_partitioning = true, hive_types_autocast = false)".format(
+                parquet_dir.rstrip('/') + '/**/*.parquet')
+        )
+
+    def execute(self, sql) -> tuple:
+        cursor = self.connection.execute(sql)
+        columns = [x[0] for x in cursor.description] if cursor.description else []
+        rows = [tuple(str(v) if v is not None else None for v in row) for row in cursor.fetchall()]
+        return columns, rows
+
+    def source(self, name) -> str:
+        return quote(self.source_table if name is None else name)
+
+    def table_exists(self, table) -> bool:
+        columns, rows = self.execute(
+            "SELECT COUNT(*) FROM information_schema.tables WHERE table_name = '{0}'".format(table))
+        return rows[0][0] != '0'
+
+    def partitions(self, table, columns) -> set:
+        columns, rows = self.execute("SELECT DISTINCT {0} FROM {1}".format(
+            ', '.join(quote(x) for x in columns), quote(table)))
+        return set(rows)
+
+    # hive partitions are discovered when the parquet files are read
+    def register_partitions(self, now, days=None) -> int:
+        return 0
+
+    def delete_partitions(self, table, columns, partitions):
+        for group in partition_groups(partitions):
+            self.execute("DELETE FROM {0} WHERE {1}".format(quote(table), partition_filter(columns, group)))
+
+    def create_progress_table(self):
+        self.execute("CREATE TABLE {0} (rollup_name VARCHAR, part VARCHAR, state VARCHAR, updated BIGINT)".format(
+            quote(PROGRESS_TABLE)))
+
+    def create_table(self, table, select_sql, partitions):
+        self.execute("CREATE TABLE {0} AS {1}".format(quote(table), select_sql))
+
+
+def quote(identifier) -> str:
+    return '"' + identifier.replace('"', '""') + '"'
+
+
+# Athena DDL statements (ALTER / CREATE EXTERNAL TABLE) quote identifiers with backticks
+def quote_ddl(identifier) -> str:
+    return '`' + identifier.replace('`', '``') + '`'
+
+
+# Returns the UTC time a partition stops receiving data
+def partition_end(values) -> datetime.datetime:
+    year, month, day = int(values[0]), int(values[1]), int(values[2])
+    start = datetime.datetime(year, month, day)
+    if len(values) > 3:
+        return start + datetime.timedelta(hours=int(values[3]) + 1)
+    return start + datetime.timedelta(days=1)
+
+
+def hour_values(hour) -> tuple:
+    return tuple(hour.strftime('%Y %m %d %H').split())
+
+
+# Hours from the first source partition until the settle cutoff that are not yet processed.
+# Hours without a source partition are included, the caller decides if they are empty.
+def pending_partitions(source_partitions, processed, now=None) -> list:
+    if not source_partitions:
+        return []
+    if now is None:
+        now = datetime.datetime.utcnow()
+    cutoff = now - datetime.timedelta(minutes=SETTLE_MINUTES)
+    first = min(source_partitions)
+    hour = datetime.datetime(int(first[0]), int(first[1]), int(first[2]), int(first[3]))
+    pending = []
+    while hour + datetime.timedelta(hours=1) <= cutoff:
+        values = hour_values(hour)
+        if values not in processed:
+            pending.append(values)
+        hour += datetime.timedelta(hours=1)
+    return pending
+
+
+# Hours to fold into a daily rollup: processed by the hourly rollup, not yet folded, and of a day
+# for which all 24 hours are processed or empty.  hour_states is dict of hour to progress state.
+def daily_pending(hour_states, folded) -> list:
+    hours_by_day = {}
+    for values in hour_states:
+        hours_by_day.setdefault(tuple(values[:3]), set()).add(values[3])
+    complete = set(day for day, hours in hours_by_day.items() if len(hours) == 24)
+    return sorted(x for x, state in hour_states.items() if state == 'done' and x[:3] in complete and x not in folded)
+
+
+# Group partitions by all but the last partition column, so that every INSERT INTO
+# stays below Athena's limit of 100 partitions per query.  Returns sorted list of groups.
+def partition_groups(partitions) -> list:
+    groups = {}
+    for values in partitions:
+        groups.setdefault(tuple(values[:-1]), []).append(tuple(values))
+    return [sorted(groups[x]) for x in sorted(groups)]
+
+
+# Build the WHERE clause covering one group of partitions
+def partition_filter(columns, group) -> str:
+    conditions = ["{0} = '{1}'".format(column, value) for column, value in zip(columns, group[0][:-1])]
+    conditions.append("{0} IN ({1})".format(columns[-1], ', '.join("'{0}'".format(x[-1]) for x in group)))
+    return ' AND '.join(conditions)
+
+
+def partition_filters(columns, partitions) -> list:
+    return [partition_filter(columns, x) for x in partition_groups(partitions)]
+
+
+def create_rollup_tables(engine):
+    if not engine.table_exists(PROGRESS_TABLE):
+        logger.info("Creating rollup progress table: {0}".format(PROGRESS_TABLE))
+        engine.create_progress_table()
+    for rollup in ROLLUPS:
+        if engine.table_exists(rollup['name']):
+            logger.info("Rollup table exists: {0}".format(rollup['name']))
+            continue
+        logger.info("Creating rollup table: {0}".format(rollup['name']))
+        select_sql = rollup['select'].format(source=engine.source(rollup['source']), where='1 = 0')
+        engine.create_table(rollup['name'], select_sql, rollup['partitions'])
+    return
+
+
+# Returns dict of rollup name to dict of partition value tuple to its latest state (done or empty)
+def processed_partitions(engine) -> dict:
+    processed = dict((x['name'], {}) for x in ROLLUPS)
+    columns, rows = engine.execute("SELECT rollup_name, part, state, updated FROM {0}".format(quote(PROGRESS_TABLE)))
+    for rollup_name, part, state, updated in sorted(rows, key=lambda x: int(x[3])):
+        states = processed.setdefault(rollup_name, {})
+        if state == 'reset':
+            states.pop(tuple(part.split('/')), None)
+        else:
+            states[tuple(part.split('/'))] = state
+    return processed
+
+
+# Record partitions with state done, empty or reset.  The latest row of a partition wins,
+# rows written by one process get strictly increasing times.
+def mark_processed(engine, rollup_name, partitions, state='done'):
+    global last_progress_time
+    if not partitions:
+        return
+    last_progress_time = max(int(time.time() * 1000), last_progress_time + 1)
+    updated = last_progress_time
+    for i in range(0, len(partitions), 500):
+        engine.execute("INSERT INTO {0} VALUES {1}".format(quote(PROGRESS_TABLE), ', '.join(
+            "('{0}', '{1}', '{2}', {3})".format(rollup_name, '/'.join(x), state, updated)
+            for x in partitions[i:i + 500])))
+
+
+# Roll up all closed partitions not yet processed into each rollup table.
+# Progress is kept in the progress table rather than inferred from the rollup partitions,
+# so hours without rows for a rollup (e.g. no REJECT flows) are not scanned again.
+# Returns dict of rollup name to number of partitions rolled up.
+def update_rollups(engine, now=None) -> dict:
+    if now is None:
+        now = datetime.datetime.utcnow()
+    create_rollup_tables(engine)
+    added_partitions = engine.register_partitions(now)
+    if added_partitions:
+        logger.info("Registered {0} new source partitions".format(added_partitions))
+    processed = processed_partitions(engine)
+    source_partitions = engine.partitions(engine.source_table, SOURCE_PARTITIONS)
+    empty_cutoff = now - datetime.timedelta(days=REGISTER_LOOKBACK_DAYS)
+    added = {}
+    for rollup in ROLLUPS:
+        states = processed[rollup['name']]
+        done = set(x for x, state in states.items() if state == 'done')
+        if rollup['source'] is None:
+            pending = pending_partitions(source_partitions, done, now)
+            with_data = [x for x in pending if x in source_partitions]
+            # hours without data may still be registered later, e.g. by the crawler after a backfill
+            empty = [x for x in pending if x not in source_partitions and x not in states
+                     and partition_end(x) <= empty_cutoff]
+        else:
+            # hours of the day are folded in once every hour is processed by the hourly rollup
+            with_data = daily_pending(processed[rollup['source']], done)
+            empty = []
+        logger.info("{0}: {1} new partitions, {2} empty".format(rollup['name'], len(with_data), len(empty)))
+        # record every group right after its INSERT, a failed run must not insert it again
+        for group in partition_groups(with_data):
+            select_sql = rollup['select'].format(source=engine.source(rollup['source']),
+                                                 where=partition_filter(HOURLY_PARTITIONS if rollup['source']
+                                                                        else SOURCE_PARTITIONS, group))
+            engine.execute("INSERT INTO {0}\n{1}".format(quote(rollup['name']), select_sql))
+            mark_processed(engine, rollup['name'], group)
+            states.update((x, 'done') for x in group)
+        mark_processed(engine, rollup['name'], empty, 'empty')
+        states.update((x, 'empty') for x in empty)
+        added[rollup['name']] = len(with_data)
+    return added
+
+
+# Delete the rollup rows of the days from start_date to end_date and reset their progress,
+# so that the next update rolls them up again from the raw table.
+# Returns dict of rollup name to number of partitions reset.
+def reprocess_rollups(engine, start_date, end_date) -> dict:
+    create_rollup_tables(engine)
+    start = datetime.datetime.strptime(start_date, '%Y-%m-%d')
+    end = datetime.datetime.strptime(end_date, '%Y-%m-%d')
+    days = [hour_values(start + datetime.timedelta(days=i))[:3] for i in range((end - start).days + 1)]
+    processed = processed_partitions(engine)
+    reset = {}
+    for rollup in ROLLUPS:
+        # rows are deleted first, an interrupted reprocess is simply run again
+        engine.delete_partitions(rollup['name'], DAILY_PARTITIONS, days)
+        partitions = sorted(x for x in processed[rollup['name']] if x[:3] in days)
+        mark_processed(engine, rollup['name'], partitions, 'reset')
+        reset[rollup['name']] = len(partitions)
+    return reset
+
+
+def render_query(name, start_date, end_date, limit=100) -> str:
+    if name not in QUERIES:
+        raise Exception("Unknown query {0}, expected one of: {1}".format(name, ', '.join(sorted(QUERIES))))
+    start = datetime.datetime.strptime(start_date, '%Y-%m-%d').strftime('%Y%m%d')
+    end = datetime.datetime.strptime(end_date, '%Y-%m-%d').strftime('%Y%m%d')
+    return QUERIES[name].format(start=start, end=end, limit=int(limit))
+
+
+def run_query(engine, name, start_date, end_date, limit=100) -> tuple:
+    return engine.execute(render_query(name, start_date, end_date, limit))
+
+
+def run_command(engine, args):
+    command = args[0] if args else 'update'
+    if command == 'create':
+        create_rollup_tables(engine)
+    elif command == 'update':
+        logger.info(update_rollups(engine))
+    elif command == 'reprocess':
+        logger.info(reprocess_rollups(engine, args[1], args[2] if len(args) > 2 else args[1]))
+        logger.info(update_rollups(engine))
+    elif command == 'query':
+        today = datetime.datetime.utcnow().strftime('%Y-%m-%d')
+        name = args[1]
+        start_date = args[2] if len(args) > 2 else today
+        end_date = args[3] if len(args) > 3 else start_date
+        limit = args[4] if len(args) > 4 else 100
+        columns, rows = run_query(engine, name, start_date, end_date, limit)
+        print('\t'.join(columns))
+        for row in rows:
+            print('\t'.join('' if x is None else x for x in row))
+    else:
+        raise Exception("Unknown command {0}, expected create, update, reprocess or query".format(command))
+    return
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if not args:
+        print(__doc__)
+        sys.exit(1)
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
+    try:
+        if args[0] == 'local':
+            engine = DuckDBEngine(args[1], args[2])
+            args = args[3:]
+        else:
+            import boto3
+            profile_name, region_name, database_name, source_table, s3bucket_name = args[:5]
+            session = boto3.Session(profile_name=profile_name)
+            engine = AthenaEngine(
+                session.client('athena', region_name=region_name),
+                session.client('glue', region_name=region_name),
+                session.client('s3', region_name=region_name),
+                database_name,
+                source_table,
+                s3bucket_name,
+            )
+            args = args[5:]
+        run_command(engine, args)
+    except Exception as e:
+        print(e)
+        logger.error(e)
+        sys.exit(1)
@@ -20,15 +20,20 @@ Steps
 12. Create IAM Service role for crawler w. policies (AWSGlueServiceRole)
 13. Create aws glue crawler for flowlogs parquet
 14. Run glue crawler to create new table in aws glue
+15. Create Athena rollup tables for dashboard queries (see athena_rollups.py)
 
 Based on:
 https://aws.amazon.com/blogs/big-data/analyze-and-visualize-your-vpc-network-traffic-using-amazon-kinesis-and-amazon-athena/
 
 NOTES:
-This solution subscribes all VPC's to single log.
+By default this solution subscribes all VPC's to single log and a single Kinesis Data Firehose stream.
 Calculate the volume of log data that will be generated.
 Be sure to create a Kinesis Data Firehose stream that can handle this volume.
 If the stream cannot handle the volume, the log stream will be throttled.
+For larger volumes pass [firehose_shards] to create N delivery streams, the Lambda routes each record
+by a stable hash of interface_id, all streams land in the same bucket and table.
+Pass [log_group_shards] to spread the VPCs over several log groups.
+firehose_shards.py recommends N from observed throughput and throttling and adds streams to a running build.
 
 Resources created:
   IAM Role(s)
@@ -44,6 +49,7 @@ Resources created:
      Table
   CW Logs Subscription Filter
   CW Dashboard
+  Athena Rollup Tables
 
 Copyright 2019 At1 LLC
 Permission is hereby granted, free of charge, to any person obtaining a copy of this software and associated documentation files (the Software), to deal in the Software without restriction, including without limitation the rights to use, copy, modify, merge, publish, distribute, sublicense, and/or sell copies of the Software, and to permit persons to whom the Software is furnished to do so, subject to the following conditions: The above copyright notice and this permission notice shall be included in all copies or substantial portions of the Software.
@@ -59,6 +65,8 @@ import time
 import string
 import random
 import logging
+import athena_rollups
+import flowlogs_format
 
 
 # Initialize logger object
@@ -141,7 +149,7 @@ def create_role_cloudwatch() -> str:
 
 # Create a new log cloudwatch log group for FlowLogs
 # Get CloudWatch Log Group ARN and return
-def logs_create_log_group() -> str:
+def logs_create_log_group(log_group_name) -> str:
     try:
         response = logs_client.create_log_group(
             logGroupName=log_group_name,
@@ -171,7 +179,7 @@ def logs_create_log_group() -> str:
     return response['logGroups'][0]['arn']
 
 
-def create_flow_log():
+def create_flow_log(log_group_name, vpc_list):
     # logger.info(delivery_role, log_group_name)
     try:
         response = ec2_client.create_flow_logs(
@@ -234,7 +242,7 @@ def create_role_lambda() -> str:
     role_arn = response['Role']['Arn']
     try:
         with open("lambda_transform_cw_kinesis_policy.json", "r") as f:
-            role_policy = f.read()
+            role_policy = f.read().replace("{{bucketName}}", s3bucket_name)
     except Exception as e:
         print(e)
         logger.error(e)
@@ -278,7 +286,9 @@ def create_flowlogs_kinesis_lambda_function() -> str:
             Publish=True,
             Environment={
                 'Variables': {
-                    'firehose_stream': kinesis_stream_name
+                    'firehose_streams': ','.join(kinesis_stream_names),
+                    'spill_bucket': s3bucket_name,
+                    'spill_prefix': flowlogs_format.DEAD_LETTER_PREFIX,
                 }
             },
         )
@@ -335,12 +345,12 @@ def create_role_kinesis() -> str:
     return role_arn
 
 
-def put_subscription_filter():
+def put_subscription_filter(log_group_name, log_group_arn, statement_id):
     logger.info("Adding cloudwatch invoke permissions for Lambda.")
     try:
         response = lambda_client.add_permission(
             FunctionName=lambda_arn,
-            StatementId='ID-1',
+            StatementId=statement_id,
             Action='lambda:InvokeFunction',
             Principal='logs.' + region_name + '.amazonaws.com',
             SourceArn=log_group_arn,
@@ -356,7 +366,7 @@ def put_subscription_filter():
         response = logs_client.put_subscription_filter(
             logGroupName=log_group_name,
             filterName=log_subscription_name,
-            filterPattern='[version, account_id, interface_id, srcaddr != "-", dstaddr != "-", srcport != "-", dstport != "-", protocol, packets, bytes, start, end, action, log_status]',
+            filterPattern=flowlogs_format.FILTER_PATTERN,
             destinationArn=lambda_arn
         )
         logger.info(response)
@@ -392,49 +402,9 @@ def create_glue_resources():
                 'StorageDescriptor': {
                     'Columns': [
                         {
-                            "Name": "start",
-                            "Type": "bigint"
-                        },
-                        {
-                            "Name": "end",
-                            "Type": "bigint"
-                        },
-                        {
-                            "Name": "srcaddr",
-                            "Type": "string"
-                        },
-                        {
-                            "Name": "dstaddr",
-                            "Type": "string"
-                        },
-                        {
-                            "Name": "srcport",
-                            "Type": "int"
-                        },
-                        {
-                            "Name": "dstport",
-                            "Type": "int"
-                        },
-                        {
-                            "Name": "protocol",
-                            "Type": "int"
-                        },
-                        {
-                            "Name": "packets",
-                            "Type": "int"
-                        },
-                        {
-                            "Name": "bytes",
-                            "Type": "int"
-                        },
-                        {
-                            "Name": "logstatus",
-                            "Type": "string"
-                        },
-                        {
-                            "Name": "action",
-                            "Type": "string"
-                        },
+                            "Name": name,
+                            "Type": column_type
+                        } for name, column_type in flowlogs_format.TABLE_COLUMNS
                     ],
                     'Location': 's3://' + s3bucket_name,
                     'InputFormat': 'org.apache.hadoop.mapred.TextInputFormat',
@@ -454,7 +424,7 @@ def create_glue_resources():
     return
 
 
-def create_kinesis_delivery_stream():
+def create_kinesis_delivery_stream(kinesis_stream_name):
     try:
         response = firehose_client.create_delivery_stream(
             DeliveryStreamName=kinesis_stream_name,
@@ -548,7 +518,9 @@ def create_glue_crawler():
                     {
                         'Path': 's3://' + s3bucket_name,
                         'Exclusions': [
-                            'string',
+                            athena_rollups.ROLLUP_PREFIX + '**',
+                            athena_rollups.ATHENA_RESULTS_PREFIX + '**',
+                            flowlogs_format.DEAD_LETTER_PREFIX + '**',
                         ]
                     },
                 ]
@@ -574,6 +546,46 @@ def start_crawler():
         sys.exit(1)
     return
 
+
+# Wait for crawler run to finish and return name of the parquet table it created,
+# or None if no flow logs reached S3 yet
+def get_crawled_table():
+    time.sleep(30)
+    try:
+        while glue_client.get_crawler(Name=glue_crawler_name)['Crawler']['State'] != 'READY':
+            time.sleep(30)
+        response = glue_client.get_tables(
+            DatabaseName=database_name,
+            Expression='vpc_flowlogs_parquet_.*'
+        )
+    except Exception as e:
+        print(e)
+        logger.error(e)
+        sys.exit(1)
+    if not response['TableList']:
+        return None
+    return response['TableList'][0]['Name']
+
+
+def create_athena_rollups():
+    engine = athena_rollups.AthenaEngine(athena_client, glue_client, s3_client, database_name,
+                                           crawled_table_name, s3bucket_name)
+    try:
+        athena_rollups.create_rollup_tables(engine)
+    except Exception as e:
+        print(e)
+        logger.error(e)
+        sys.exit(1)
+    return
+
+
+# Returns [name] for a single shard, else name-0 ... name-(N-1)
+def sharded_names(name, shards) -> list:
+    if shards <= 1:
+        return [name]
+    return [name + "-" + str(i) for i in range(shards)]
+
+
 # return a random 6 character string for application name
 def randomstring():
     chars = string.ascii_lowercase + string.digits
@@ -583,12 +595,14 @@ def randomstring():
 if __name__ == '__main__':
     args = sys.argv[1:]
     if not args:
-        print("This program generates CloudWatch FlowLogs for an AWS account\nusage: [profile_name] [account_id] [region_name]")
+        print("This program generates CloudWatch FlowLogs for an AWS account\nusage: [profile_name] [account_id] [region_name] [firehose_shards] [log_group_shards]")
         sys.exit(1)
     else:
         profile_name = args[0]
         account_id = args[1]
         region_name = args[2]
+        firehose_shards = int(args[3]) if len(args) > 3 else 1
+        log_group_shards = int(args[4]) if len(args) > 4 else 1
     logger = initialize_logger('./')
     logger.info("Starting VPC CloudWatch FlowLogs solution build")
     try:
@@ -621,20 +635,28 @@ if __name__ == '__main__':
     table_name = "vpc-flow-logs-table" + stack_name
     glue_crawler_role_name = "glue-crawler-flowlogs-kinesis-role" + stack_name
     glue_crawler_name = "glue-crawler-vpc-flowlogs" + stack_name
+    # Sharded mode: several delivery streams / log groups, suffixed with the shard number
+    kinesis_stream_names = sharded_names(kinesis_stream_name, firehose_shards)
+    log_group_names = sharded_names(log_group_name, log_group_shards)
     # Start Process
     logger.info("1. Collecting all VPCs in region")
     vpc_list = get_VPC_list()
     logger.info(vpc_list)
+    log_group_names = log_group_names[:max(1, len(vpc_list))]
     logger.info("2. Creating IAM role and policy for flowlog delivery")
     logger.info("IAM ROLE: {0}".format(cloudwatch_vpc_iam_role_name))
     delivery_role_arn = create_role_cloudwatch()
     time.sleep(15)
     logger.info("3. Creating CloudWatch Log Group")
-    logger.info("LOG GROUP NAME: {0}".format(log_group_name))
-    log_group_arn = logs_create_log_group()
+    log_group_arns = []
+    for name in log_group_names:
+        logger.info("LOG GROUP NAME: {0}".format(name))
+        log_group_arns.append(logs_create_log_group(name))
     time.sleep(20)
     logger.info("4. Creating VPC Flow Logs to deliver logs to CloudWatch")
-    create_flow_log()
+    for i, name in enumerate(log_group_names):
+        # spread VPCs round robin over the log groups
+        create_flow_log(name, vpc_list[i::len(log_group_names)])
     logger.info("5. Creating S3 destination bucket for kinesis")
     logger.info("S3 BUCKET NAME: {0}".format(s3bucket_name))
     s3_create_bucket()
@@ -648,12 +670,15 @@ if __name__ == '__main__':
     logger.info("9.  Create Glue Database and Table Schema")
     create_glue_resources()
     logger.info("10. Create a Kinesis Data Firehose delivery stream")
-    create_kinesis_delivery_stream()
+    for name in kinesis_stream_names:
+        logger.info("KINESIS STREAM NAME: {0}".format(name))
+        create_kinesis_delivery_stream(name)
     logger.info("Wait until Stream becomes active")
     # Could instead check on the resource and see if it's active
     time.sleep(180)
     logger.info("11. Create a subscription filter from FlowLogs to Lambda")
-    put_subscription_filter()
+    for i, name in enumerate(log_group_names):
+        put_subscription_filter(name, log_group_arns[i], 'ID-' + str(i + 1))
     logger.info("12. Create IAM Service role for crawler w. policies (AWSGlueServiceRole)")
     glue_crawler_role_arn = create_role_crawler()
     logger.info("13. Create aws glue crawler for flowlogs parquet")
@@ -664,3 +689,15 @@ if __name__ == '__main__':
     time.sleep(600)
     logger.info("14. Run glue crawler to create new table in aws glue")
     start_crawler()
+    logger.info("15. Create Athena rollup tables for dashboard queries")
+    crawled_table_name = get_crawled_table()
+    if crawled_table_name is None:
+        # idle VPCs or the Firehose buffer interval, the daily crawler run creates the table later
+        logger.warning("Crawler did not create a parquet table yet, no flow logs in S3. Once the crawler created the "
+                       "vpc_flowlogs_parquet_ table, create the rollup tables with: athena_rollups.py {0} {1} {2} "
+                       "[source_table] {3} create".format(profile_name, region_name, database_name, s3bucket_name))
+    else:
+        logger.info("PARQUET TABLE NAME: {0}".format(crawled_table_name))
+        create_athena_rollups()
+        logger.info("Schedule rollup updates with: athena_rollups.py {0} {1} {2} {3} {4} update".format(
+            profile_name, region_name, database_name, crawled_table_name, s3bucket_name))
@@ -0,0 +1,189 @@
+#!/bin/python3
+"""
+Size the number of Kinesis Data Firehose delivery streams (shards) for the FlowLogs Lambda
+
+The transformation Lambda routes records over the delivery streams listed in its
+firehose_streams environment variable, by a stable hash of interface_id.  Every stream
+has its own records/sec, requests/sec and bytes/sec quota, so the number of streams
+caps the flow log volume the solution can ingest.
+
+recommend
+  Reads per stream Firehose metrics for the last [hours] and returns the number of
+  streams needed to keep peak throughput below TARGET_UTILIZATION of the stream quota.
+  Streams reporting ThrottledRecords always get at least one more shard.
+apply
+  Adds delivery streams with the configuration of the first stream until there are
+  [shards] streams, then updates the Lambda environment to route over all of them.
+  Streams are only added, data already buffered in a stream is never dropped.
+
+Per shard metrics written by the Lambda are in the VPCFlowLogs CloudWatch namespace
+(ShardRecords, ShardBytes, ShardFailedRecords by DeliveryStreamName).
+
+usage: [profile_name] [region_name] [lambda_name] recommend [hours]
+       [profile_name] [region_name] [lambda_name] apply [shards]
+"""
+
+import sys
+import math
+import time
+import datetime
+import logging
+
+
+logger = logging.getLogger(__name__)
+
+TARGET_UTILIZATION = 0.7
+# get_metric_statistics returns at most 1440 datapoints per call
+MAX_DATAPOINTS = 1440
+
+# Default direct put quotas, used when the stream does not report its limits
+DEFAULT_LIMITS_LARGE_REGIONS = {'records': 500000, 'requests': 2000, 'bytes': 5 * 1024 * 1024}
+DEFAULT_LIMITS = {'records': 100000, 'requests': 1000, 'bytes': 1024 * 1024}
+LARGE_REGIONS = ['us-east-1', 'us-west-2', 'eu-west-1']
+
+# metric name of throughput, metric name of the stream limit
+METRICS = {
+    'records': ('IncomingRecords', 'RecordsPerSecondLimit'),
+    'requests': ('IncomingPutRequests', 'PutRequestsPerSecondLimit'),
+    'bytes': ('IncomingBytes', 'BytesPerSecondLimit'),
+}
+
+# ExtendedS3 destination settings copied when adding streams
+COPIED_DESTINATION_KEYS = ['RoleARN', 'BucketARN', 'Prefix', 'ErrorOutputPrefix', 'BufferingHints',
+                           'CompressionFormat', 'EncryptionConfiguration', 'CloudWatchLoggingOptions',
+                           'ProcessingConfiguration', 'DataFormatConversionConfiguration']
+
+
+def get_stream_names(lambda_client, lambda_name) -> list:
+    response = lambda_client.get_function_configuration(FunctionName=lambda_name)
+    variables = response['Environment']['Variables']
+    return variables.get('firehose_streams', variables.get('firehose_stream', '')).split(',')
+
+
+# Smallest period (a multiple of 60 seconds) that fits hours in MAX_DATAPOINTS datapoints
+def metric_period(hours) -> int:
+    return max(1, int(math.ceil(hours * 3600.0 / MAX_DATAPOINTS / 60))) * 60
+
+
+# Returns dict of timestamp to value for one Firehose metric of one stream
+def get_metric(cloudwatch_client, stream_name, metric_name, statistic, start, end, period) -> dict:
+    response = cloudwatch_client.get_metric_statistics(
+        Namespace='AWS/Firehose',
+        MetricName=metric_name,
+        Dimensions=[{'Name': 'DeliveryStreamName', 'Value': stream_name}],
+        StartTime=start,
+        EndTime=end,
+        Period=period,
+        Statistics=[statistic],
+    )
+    return dict((x['Timestamp'], x[statistic]) for x in response['Datapoints'])
+
+
+# Returns (recommended shards, details dict)
+def recommend_shards(cloudwatch_client, stream_names, region_name, hours=24) -> tuple:
+    end = datetime.datetime.utcnow()
+    start = end - datetime.timedelta(hours=hours)
+    period = metric_period(hours)
+    defaults = DEFAULT_LIMITS_LARGE_REGIONS if region_name in LARGE_REGIONS else DEFAULT_LIMITS
+    needed = 1
+    details = {'streams': len(stream_names), 'throttled_records': 0}
+    for kind, (metric_name, limit_name) in METRICS.items():
+        # sum streams per period, then take the peak per second across the whole solution
+        totals = {}
+        limits = []
+        for stream_name in stream_names:
+            for timestamp, value in get_metric(cloudwatch_client, stream_name, metric_name, 'Sum', start, end, period).items():
+                totals[timestamp] = totals.get(timestamp, 0) + value
+            limits.extend(get_metric(cloudwatch_client, stream_name, limit_name, 'Minimum', start, end, period).values())
+        # peaks are averaged over the period, longer lookbacks smooth out short bursts
+        peak = max(totals.values()) / period if totals else 0
+        limit = min(limits) if limits else defaults[kind]
+        details['peak_' + kind + '_per_second'] = peak
+        details[kind + '_limit'] = limit
+        needed = max(needed, int(math.ceil(peak / (limit * TARGET_UTILIZATION))))
+    for stream_name in stream_names:
+        throttled = get_metric(cloudwatch_client, stream_name, 'ThrottledRecords', 'Sum', start, end, period)
+        details['throttled_records'] += sum(throttled.values())
+    if details['throttled_records'] > 0:
+        needed = max(needed, len(stream_names) + 1)
+    return needed, details
+
+
+def wait_for_active(firehose_client, stream_name):
+    while True:
+        response = firehose_client.describe_delivery_stream(DeliveryStreamName=stream_name)
+        status = response['DeliveryStreamDescription']['DeliveryStreamStatus']
+        if status == 'ACTIVE':
+            return
+        if status != 'CREATING':
+            raise Exception("Delivery stream {0} is {1}".format(stream_name, status))
+        time.sleep(15)
+
+
+# Add delivery streams copying the first stream until there are shards streams.
+# Returns the new list of stream names.
+def add_shards(firehose_client, lambda_client, lambda_name, shards) -> list:
+    stream_names = get_stream_names(lambda_client, lambda_name)
+    if shards <= len(stream_names):
+        logger.info("Already {0} delivery streams".format(len(stream_names)))
+        return stream_names
+    response = firehose_client.describe_delivery_stream(DeliveryStreamName=stream_names[0])
+    destination = response['DeliveryStreamDescription']['Destinations'][0]['ExtendedS3DestinationDescription']
+    configuration = dict((x, destination[x]) for x in COPIED_DESTINATION_KEYS if x in destination)
+    base_name = stream_names[0][:-2] if stream_names[0].endswith('-0') else stream_names[0]
+    new_names = [base_name + "-" + str(i) for i in range(len(stream_names), shards)]
+    for name in new_names:
+        logger.info("Creating delivery stream {0}".format(name))
+        firehose_client.create_delivery_stream(
+            DeliveryStreamName=name,
+            ExtendedS3DestinationConfiguration=configuration,
+        )
+    for name in new_names:
+        wait_for_active(firehose_client, name)
+    stream_names = stream_names + new_names
+    response = lambda_client.get_function_configuration(FunctionName=lambda_name)
+    variables = response['Environment']['Variables']
+    variables['firehose_streams'] = ','.join(stream_names)
+    lambda_client.update_function_configuration(
+        FunctionName=lambda_name,
+        Environment={
+            'Variables': variables
+        },
+    )
+    logger.info("Lambda {0} now routes over {1} delivery streams".format(lambda_name, len(stream_names)))
+    return stream_names
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) < 4:
+        print(__doc__)
+        sys.exit(1)
+    profile_name, region_name, lambda_name, command = args[:4]
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
+    try:
+        import boto3
+        session = boto3.Session(profile_name=profile_name)
+        cloudwatch_client = session.client('cloudwatch', region_name=region_name)
+        firehose_client = session.client('firehose', region_name=region_name)
+        lambda_client = session.client('lambda', region_name=region_name)
+    except Exception as e:
+        print(e)
+        logger.error(e)
+        raise Exception("Error with AWS credentials")
+    try:
+        if command == 'recommend':
+            hours = int(args[4]) if len(args) > 4 else 24
+            stream_names = get_stream_names(lambda_client, lambda_name)
+            shards, details = recommend_shards(cloudwatch_client, stream_names, region_name, hours)
+            logger.info(details)
+            print("Recommended delivery streams: {0} (currently {1})".format(shards, len(stream_names)))
+        elif command == 'apply':
+            add_shards(firehose_client, lambda_client, lambda_name, int(args[4]))
+        else:
+            print(__doc__)
+            sys.exit(1)
+    except Exception as e:
+        print(e)
+        logger.error(e)
+        sys.exit(1)
@@ -0,0 +1,264 @@
+#!/bin/python3
+"""
+Parallel historical backfill from the CloudWatch FlowLogs log group into the parquet lake
+
+The subscription filter only delivers flow logs from the moment it is created.  This
+script reads the records already kept in the log group (731 day retention) and writes
+them to the S3 bucket in the same layout and schema as the Kinesis Firehose output,
+partitioned by the hour of the log event (YYYY/MM/DD/HH/).
+
+Steps
+1.  List log streams with events in the requested time range
+2.  Split the range into shards of one log stream and one time window
+3.  Read shards in parallel with filter_log_events pagination
+4.  Parse records with the subscription filter parser (flowlogs_format.py)
+5.  Write one parquet object per shard and hour to S3
+6.  Record finished shards in the checkpoint file
+
+The subscription filter forwards events ingested after its creation time, so records
+ingested from then on are skipped (and the range is clamped to it), they were already
+delivered by Kinesis Firehose.
+
+Interrupted backfills resume from the checkpoint file; shards are written to fixed object
+keys, so a shard that was only partly written is overwritten when it is read again.  Shard
+ids depend on the range and window, a checkpoint is only resumed with the same ones.
+Run the glue crawler afterwards to register the new partitions, then athena_rollups.py
+reprocess over the backfilled dates so that update rolls them up (the hour the subscription
+filter was created gets both backfilled and Firehose records).
+
+Requires pyarrow for writing parquet.
+
+usage: [profile_name] [region_name] [log_group_name] [s3bucket_name] [start YYYY-MM-DD] [end YYYY-MM-DD]
+       [checkpoint_file] [window_hours] [workers]
+"""
+
+import os
+import sys
+import hashlib
+import logging
+import datetime
+import threading
+from io import BytesIO
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from flowlogs_format import TABLE_COLUMNS, event_fields
+
+
+logger = logging.getLogger(__name__)
+
+HOUR_MS = 3600 * 1000
+
+
+class Checkpoint:
+    # Append only file of finished shard ids, one per line, after a header line with the
+    # run parameters the shard ids were made from
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.run = None
+        self.completed = set()
+        if path and os.path.exists(path):
+            with open(path, "r") as f:
+                lines = [x.strip() for x in f if x.strip()]
+            if lines and lines[0].startswith('#'):
+                self.run = lines.pop(0)[1:].strip()
+            self.completed = set(lines)
+
+    # Record the run parameters, or refuse to resume a checkpoint of different ones:
+    # their shards have other ids and object keys, redoing them would duplicate rows.
+    def start(self, run):
+        if self.run is None:
+            self.run = run
+            if self.path:
+                with open(self.path, "a") as f:
+                    f.write('# ' + run + '\n')
+        elif self.run != run:
+            raise Exception("Checkpoint {0} is for {1}, not {2}; use another checkpoint file".format(
+                self.path, self.run, run))
+
+    def done(self, shard_id) -> bool:
+        return shard_id in self.completed
+
+    def complete(self, shard_id):
+        with self.lock:
+            self.completed.add(shard_id)
+            if not self.path:
+                return
+            with open(self.path, "a") as f:
+                f.write(shard_id + '\n')
+
+
+def to_epoch_ms(date_string) -> int:
+    date = datetime.datetime.strptime(date_string, '%Y-%m-%d')
+    return int((date - datetime.datetime(1970, 1, 1)).total_seconds()) * 1000
+
+
+# Returns creation time (epoch ms) of the first subscription filter on the log group, or None
+def subscription_start(logs_client, log_group_name):
+    response = logs_client.describe_subscription_filters(logGroupName=log_group_name)
+    created = [x['creationTime'] for x in response['subscriptionFilters']]
+    return min(created) if created else None
+
+
+# Returns (name, first event ms, last event ms) of log streams with events between start_ms and end_ms
+def list_log_streams(logs_client, log_group_name, start_ms, end_ms) -> list:
+    streams = []
+    paginator = logs_client.get_paginator('describe_log_streams')
+    for page in paginator.paginate(logGroupName=log_group_name):
+        for stream in page['logStreams']:
+            first = stream.get('firstEventTimestamp', stream.get('creationTime', 0))
+            last = stream.get('lastEventTimestamp', stream.get('lastIngestionTime', end_ms))
+            if first < end_ms and last >= start_ms:
+                streams.append((stream['logStreamName'], first, last))
+    return streams
+
+
+# Split the time range into windows of window_hours starting at start_ms, and give every
+# stream only the windows that overlap its own events.  Window boundaries do not depend on
+# the stream range, so shard ids stay the same between runs.
+# Returns list of (shard_id, log_stream_name, start_ms, end_ms)
+def make_shards(streams, start_ms, end_ms, window_hours) -> list:
+    window_ms = window_hours * HOUR_MS
+    shards = []
+    for stream, first, last in streams:
+        window_start = start_ms + max(0, first - start_ms) // window_ms * window_ms
+        stream_end = min(end_ms, last + 1)
+        while window_start < stream_end:
+            window_end = min(window_start + window_ms, end_ms)
+            shard_id = "{0}|{1}|{2}".format(stream, window_start, window_end)
+            shards.append((shard_id, stream, window_start, window_end))
+            window_start = window_end
+    return shards
+
+
+# Read one shard and return dict of partition prefix (YYYY/MM/DD/HH/) to table rows.
+# Events ingested at or after created (epoch ms) were delivered by the subscription filter.
+def read_shard(logs_client, log_group_name, stream, start_ms, end_ms, created=None) -> dict:
+    partitions = {}
+    paginator = logs_client.get_paginator('filter_log_events')
+    for page in paginator.paginate(logGroupName=log_group_name, logStreamNames=[stream],
+                                   startTime=start_ms, endTime=end_ms - 1):
+        for log_event in page['events']:
+            if created is not None and log_event['ingestionTime'] >= created:
+                continue
+            fields = event_fields(log_event)
+            if fields is None:
+                continue
+            prefix = datetime.datetime.utcfromtimestamp(log_event['timestamp'] / 1000.0).strftime('%Y/%m/%d/%H/')
+            partitions.setdefault(prefix, []).append(table_row(fields))
+    return partitions
+
+
+# Convert parsed flow log fields to the types of the glue table
+def table_row(fields) -> dict:
+    row = {}
+    for name, column_type in TABLE_COLUMNS:
+        value = fields.get('log_status') if name == 'logstatus' else fields.get(name)
+        if column_type != 'string':
+            value = int(value) if value not in (None, '-') else None
+        row[name] = value
+    return row
+
+
+def parquet_bytes(rows) -> bytes:
+    import pyarrow
+    import pyarrow.parquet
+    types = {'bigint': pyarrow.int64(), 'int': pyarrow.int32(), 'string': pyarrow.string()}
+    schema = pyarrow.schema([(name, types[column_type]) for name, column_type in TABLE_COLUMNS])
+    table = pyarrow.Table.from_pylist(rows, schema=schema)
+    buffer = BytesIO()
+    pyarrow.parquet.write_table(table, buffer, compression='snappy')
+    return buffer.getvalue()
+
+
+# Read, convert and write one shard.  Returns number of records written.
+def backfill_shard(logs_client, write_object, log_group_name, shard, created=None) -> int:
+    shard_id, stream, start_ms, end_ms = shard
+    shard_key = hashlib.sha1(shard_id.encode()).hexdigest()[:16]
+    count = 0
+    for prefix, rows in sorted(read_shard(logs_client, log_group_name, stream, start_ms, end_ms, created).items()):
+        write_object(prefix + 'backfill-' + shard_key + '.parquet', parquet_bytes(rows))
+        count += len(rows)
+    return count
+
+
+# Backfill all shards not in the checkpoint using a pool of worker threads.
+# Records ingested after the creation of the subscription filter were already delivered by
+# Firehose, they are skipped.  write_object(key, body) stores one object in the lake.
+# Returns dict with number of shards done, skipped, failed and records written.
+def run_backfill(logs_client, write_object, log_group_name, start_ms, end_ms, checkpoint,
+                 window_hours=6, workers=8) -> dict:
+    created = subscription_start(logs_client, log_group_name)
+    if created is not None and end_ms > created:
+        logger.warning("Subscription filter created at {0}, backfilling only until then".format(
+            datetime.datetime.utcfromtimestamp(created / 1000.0)))
+        end_ms = max(start_ms, created)
+    checkpoint.start("start={0} end={1} window_hours={2}".format(start_ms, end_ms, window_hours))
+    streams = list_log_streams(logs_client, log_group_name, start_ms, end_ms)
+    shards = make_shards(streams, start_ms, end_ms, window_hours)
+    pending = [x for x in shards if not checkpoint.done(x[0])]
+    logger.info("{0} log streams, {1} shards, {2} already done".format(
+        len(streams), len(shards), len(shards) - len(pending)))
+    stats = {'shards': 0, 'skipped': len(shards) - len(pending), 'failed': 0, 'records': 0}
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {
+            executor.submit(backfill_shard, logs_client, write_object, log_group_name, shard, created): shard
+            for shard in pending
+        }
+        for future in as_completed(futures):
+            shard_id = futures[future][0]
+            try:
+                count = future.result()
+            except Exception as e:
+                logger.error("Shard {0} failed: {1}".format(shard_id, e))
+                stats['failed'] += 1
+                continue
+            checkpoint.complete(shard_id)
+            stats['shards'] += 1
+            stats['records'] += count
+            logger.info("Shard {0}: {1} records ({2}/{3})".format(
+                shard_id, count, stats['shards'] + stats['skipped'], len(shards)))
+    return stats
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) < 6:
+        print("This program backfills CloudWatch FlowLogs into the parquet S3 bucket\n"
+              "usage: [profile_name] [region_name] [log_group_name] [s3bucket_name] [start YYYY-MM-DD] [end YYYY-MM-DD] "
+              "[checkpoint_file] [window_hours] [workers]")
+        sys.exit(1)
+    profile_name, region_name, log_group_name, s3bucket_name, start_date, end_date = args[:6]
+    checkpoint_file = args[6] if len(args) > 6 else "backfill-" + log_group_name + ".checkpoint"
+    window_hours = int(args[7]) if len(args) > 7 else 6
+    workers = int(args[8]) if len(args) > 8 else 8
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
+    try:
+        import boto3
+        from botocore.config import Config
+        session = boto3.Session(profile_name=profile_name)
+        # FilterLogEvents has a low request quota, let the client back off when throttled
+        client_config = Config(retries={'max_attempts': 10, 'mode': 'adaptive'}, max_pool_connections=workers)
+        logs_client = session.client('logs', region_name=region_name, config=client_config)
+        s3_client = session.client('s3', region_name=region_name, config=client_config)
+    except Exception as e:
+        print(e)
+        logger.error(e)
+        raise Exception("Error with AWS credentials")
+
+    def write_object(key, body):
+        s3_client.put_object(Bucket=s3bucket_name, Key=key, Body=body)
+
+    try:
+        stats = run_backfill(logs_client, write_object, log_group_name, to_epoch_ms(start_date),
+                             to_epoch_ms(end_date), Checkpoint(checkpoint_file), window_hours, workers)
+    except Exception as e:
+        print(e)
+        logger.error(e)
+        sys.exit(1)
+    logger.info(stats)
+    if stats['failed']:
+        logger.error("{0} shards failed, run again to retry them".format(stats['failed']))
+        sys.exit(1)
+    logger.info("Backfill complete, run the glue crawler to register new partitions, then athena_rollups.py "
+                "reprocess {0} {1}".format(start_date, end_date))
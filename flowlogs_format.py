@@ -0,0 +1,54 @@
+"""
+VPC FlowLogs record format shared by the build, the transformation Lambda, the backfill and the replay.
+
+Packaged with lambda_flowlogs_transform_kinesis.py in lambda_flowlogs_kinesis_package.zip
+"""
+
+
+# Prefix in the flow logs bucket for records the Lambda could not deliver to Firehose
+DEAD_LETTER_PREFIX = 'dead-letter/'
+
+# Fields of a version 2 flow log record, in message order
+FLOWLOG_FIELDS = ['version', 'account_id', 'interface_id', 'srcaddr', 'dstaddr', 'srcport', 'dstport',
+                  'protocol', 'packets', 'bytes', 'start', 'end', 'action', 'log_status']
+
+# Subscription filter pattern, skips NODATA / SKIPDATA records
+FILTER_PATTERN = '[version, account_id, interface_id, srcaddr != "-", dstaddr != "-", srcport != "-", ' \
+                 'dstport != "-", protocol, packets, bytes, start, end, action, log_status]'
+FILTERED_FIELDS = ['srcaddr', 'dstaddr', 'srcport', 'dstport']
+
+# Glue table schema of the flow logs, used by Firehose for the parquet conversion
+TABLE_COLUMNS = [
+    ('start', 'bigint'),
+    ('end', 'bigint'),
+    ('srcaddr', 'string'),
+    ('dstaddr', 'string'),
+    ('srcport', 'int'),
+    ('dstport', 'int'),
+    ('protocol', 'int'),
+    ('packets', 'int'),
+    ('bytes', 'int'),
+    ('logstatus', 'string'),
+    ('action', 'string'),
+    ('interface_id', 'string'),
+    ('account_id', 'string'),
+]
+
+
+# Parse a raw flow log message the same way the subscription filter does.
+# Returns dict of fields or None if the record does not match the filter pattern.
+def parse_message(message):
+    values = message.split()
+    if len(values) != len(FLOWLOG_FIELDS):
+        return None
+    fields = dict(zip(FLOWLOG_FIELDS, values))
+    if any(fields[x] == '-' for x in FILTERED_FIELDS):
+        return None
+    return fields
+
+
+# Returns flow log fields of a CloudWatch log event, or None if it should be skipped
+def event_fields(log_event):
+    if 'extractedFields' in log_event:
+        return log_event['extractedFields']
+    return parse_message(log_event['message'])
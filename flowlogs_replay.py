@@ -0,0 +1,199 @@
+#!/bin/python3
+"""
+Replay flow log records spilled by the transformation Lambda to the dead-letter prefix
+
+When Firehose keeps rejecting records, or the invocation is about to time out, the Lambda
+writes what it could not deliver to s3://bucket/dead-letter/YYYY/MM/DD/HH/ as compressed
+JSON lines ({"id": log event id, "stream": delivery stream, "data": record}) instead of
+failing, so an incident does not turn into a Lambda retry storm.  This script re-drives
+those records once the incident is over.
+
+Steps
+1.  List spilled objects, oldest first
+2.  Drop records whose CloudWatch log event id was already replayed (ledger file) or
+    appears more than once
+3.  Send records to their delivery stream at no more than [rate] records per second
+4.  Record replayed ids in the ledger, delete the object once all its records are delivered
+
+Replay stops at the first batch that still fails after retries; spilled objects that were not
+fully delivered stay in place for the next run.
+
+usage: [profile_name] [region_name] [s3bucket_name] [rate] [ledger_file] [prefix]
+"""
+
+import os
+import sys
+import gzip
+import json
+import time
+import logging
+from io import BytesIO
+
+from flowlogs_format import DEAD_LETTER_PREFIX
+
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 500
+MAX_ATTEMPTS = 5
+
+
+class LocalObjectStore:
+    # Directory backed stand-in for the S3 client calls used by the Lambda spill and the replay
+    def __init__(self, root):
+        self.root = root
+
+    def path(self, Bucket, Key):
+        return os.path.join(self.root, Bucket, *Key.split('/'))
+
+    def put_object(self, Bucket, Key, Body):
+        path = self.path(Bucket, Key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(Body)
+        return {}
+
+    def get_object(self, Bucket, Key):
+        with open(self.path(Bucket, Key), "rb") as f:
+            return {'Body': BytesIO(f.read())}
+
+    def delete_object(self, Bucket, Key):
+        os.remove(self.path(Bucket, Key))
+        return {}
+
+    def get_paginator(self, operation_name):
+        return self
+
+    # list_objects_v2 pagination, a single page
+    def paginate(self, Bucket, Prefix=''):
+        keys = []
+        for directory, _, files in os.walk(os.path.join(self.root, Bucket)):
+            for name in files:
+                key = os.path.relpath(os.path.join(directory, name), os.path.join(self.root, Bucket))
+                key = key.replace(os.sep, '/')
+                if key.startswith(Prefix):
+                    keys.append(key)
+        yield {'Contents': [{'Key': x} for x in sorted(keys)]}
+
+
+class Ledger:
+    # Append only file of replayed log event ids
+    def __init__(self, path):
+        self.path = path
+        self.ids = set()
+        if path and os.path.exists(path):
+            with open(path, "r") as f:
+                self.ids = set(x.strip() for x in f if x.strip())
+
+    def __contains__(self, event_id):
+        return event_id in self.ids
+
+    def add(self, event_ids):
+        self.ids.update(event_ids)
+        if not self.path:
+            return
+        with open(self.path, "a") as f:
+            f.write(''.join(x + '\n' for x in event_ids))
+
+
+class RateLimiter:
+    def __init__(self, rate):
+        self.rate = float(rate)
+        self.next_time = time.time()
+
+    def wait(self, records):
+        now = time.time()
+        if self.next_time > now:
+            time.sleep(self.next_time - now)
+        self.next_time = max(now, self.next_time) + records / self.rate
+
+
+def list_spill_objects(s3_client, s3bucket_name, prefix) -> list:
+    keys = []
+    paginator = s3_client.get_paginator('list_objects_v2')
+    for page in paginator.paginate(Bucket=s3bucket_name, Prefix=prefix):
+        keys.extend(x['Key'] for x in page.get('Contents', []))
+    return sorted(keys)
+
+
+def read_spill_object(s3_client, s3bucket_name, key) -> list:
+    body = s3_client.get_object(Bucket=s3bucket_name, Key=key)['Body'].read()
+    return [json.loads(x) for x in gzip.decompress(body).decode().splitlines() if x]
+
+
+# Send one batch, retrying rejected records with backoff.  Returns the entries still not delivered.
+def deliver_batch(firehose_client, stream_name, entries) -> list:
+    pending = entries
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            response = firehose_client.put_record_batch(
+                DeliveryStreamName=stream_name,
+                Records=[{'Data': x['data'].encode()} for x in pending]
+            )
+        except Exception as e:
+            logger.error(e)
+        else:
+            pending = [pending[i] for i, x in enumerate(response['RequestResponses']) if 'ErrorCode' in x]
+            if not pending:
+                return []
+        time.sleep(min(2 ** attempt, 30))
+    return pending
+
+
+# Replay all spilled objects under prefix.  Returns dict of counts.
+def replay(s3_client, firehose_client, s3bucket_name, ledger, rate=500, prefix=DEAD_LETTER_PREFIX) -> dict:
+    limiter = RateLimiter(rate)
+    stats = {'objects': 0, 'records': 0, 'duplicates': 0, 'failed': False}
+    for key in list_spill_objects(s3_client, s3bucket_name, prefix):
+        streams = {}
+        seen = set()
+        for entry in read_spill_object(s3_client, s3bucket_name, key):
+            if entry['id'] in ledger or entry['id'] in seen:
+                stats['duplicates'] += 1
+                continue
+            seen.add(entry['id'])
+            streams.setdefault(entry['stream'], []).append(entry)
+        for stream_name, entries in sorted(streams.items()):
+            for i in range(0, len(entries), BATCH_SIZE):
+                batch = entries[i:i + BATCH_SIZE]
+                limiter.wait(len(batch))
+                pending = deliver_batch(firehose_client, stream_name, batch)
+                # records accepted by Firehose are in the ledger even if the batch failed
+                failed = set(x['id'] for x in pending)
+                delivered = [x['id'] for x in batch if x['id'] not in failed]
+                ledger.add(delivered)
+                stats['records'] += len(delivered)
+                if pending:
+                    logger.error("Delivery to {0} still failing, stopping replay at {1}".format(stream_name, key))
+                    stats['failed'] = True
+                    return stats
+        s3_client.delete_object(Bucket=s3bucket_name, Key=key)
+        stats['objects'] += 1
+        logger.info("Replayed {0}".format(key))
+    return stats
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) < 3:
+        print("This program replays spilled FlowLogs records to Kinesis Firehose\n"
+              "usage: [profile_name] [region_name] [s3bucket_name] [rate] [ledger_file] [prefix]")
+        sys.exit(1)
+    profile_name, region_name, s3bucket_name = args[:3]
+    rate = float(args[3]) if len(args) > 3 else 500
+    ledger_file = args[4] if len(args) > 4 else "replay-" + s3bucket_name + ".ledger"
+    prefix = args[5] if len(args) > 5 else DEAD_LETTER_PREFIX
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s - %(message)s")
+    try:
+        import boto3
+        session = boto3.Session(profile_name=profile_name)
+        s3_client = session.client('s3', region_name=region_name)
+        firehose_client = session.client('firehose', region_name=region_name)
+    except Exception as e:
+        print(e)
+        logger.error(e)
+        raise Exception("Error with AWS credentials")
+    stats = replay(s3_client, firehose_client, s3bucket_name, Ledger(ledger_file), rate, prefix)
+    logger.info(stats)
+    if stats['failed']:
+        sys.exit(1)
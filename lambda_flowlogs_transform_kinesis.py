@@ -2,19 +2,39 @@
 Adam Shechter
 at1
 
-
+Environment
+  firehose_streams  comma separated delivery stream names; records are routed to a stream by a
+                    stable hash of shard_key so one stream's quota does not cap the whole volume
+  firehose_stream   single delivery stream name (used when firehose_streams is not set)
+  shard_key         interface_id (default) or log_group
+  spill_bucket      bucket for records Firehose did not accept after retries, or that were left when
+                    the invocation was about to time out; replayed later with flowlogs_replay.py
+  spill_prefix      dead-letter prefix in spill_bucket (default dead-letter/)
 """
 
 
 import os
 import boto3
+from botocore.config import Config
 import gzip
 import json
 import datetime
 import base64
+import time
+import zlib
 from io import BytesIO
+from flowlogs_format import event_fields, DEAD_LETTER_PREFIX
+
+# put_record_batch attempts per batch, and time kept back to spill what is left.
+# Client timeouts are well below the reserve and botocore retries are disabled (a single
+# attempt in standard mode), so one slow call cannot use up the rest of the invocation.
+MAX_ATTEMPTS = 4
+SPILL_RESERVE_MS = 10000
 
-firehose_client = boto3.client('firehose')
+firehose_client = boto3.client('firehose', config=Config(
+    connect_timeout=1, read_timeout=4, retries={'max_attempts': 1, 'mode': 'standard'}))
+s3_client = boto3.client('s3', config=Config(
+    connect_timeout=1, read_timeout=3, retries={'max_attempts': 1, 'mode': 'standard'}))
 
 
 # function to send record to Kinesis Firehose
@@ -26,6 +46,98 @@ def SendToFireHose(streamName, records):
     print(response)
     #log the number of data points written to Kinesis
     print("Wrote the following records to Firehose: " + str(len(records)))
+    return response
+
+
+def TimeLeft(context):
+    if context is None:
+        return SPILL_RESERVE_MS * 10
+    return context.get_remaining_time_in_millis()
+
+
+# Send a batch, retrying only the records Firehose rejected while there is time left.
+# Returns the indexes of the records that could not be delivered.
+def DeliverBatch(streamName, records, context):
+    pending = list(range(len(records)))
+    for attempt in range(MAX_ATTEMPTS):
+        if TimeLeft(context) < SPILL_RESERVE_MS:
+            break
+        try:
+            response = SendToFireHose(streamName, [records[i] for i in pending])
+        except Exception as e:
+            print(e)
+        else:
+            pending = [pending[i] for i, x in enumerate(response['RequestResponses']) if 'ErrorCode' in x]
+        if not pending:
+            break
+        backoff = min(0.2 * 2 ** attempt, 2)
+        if TimeLeft(context) - backoff * 1000 < SPILL_RESERVE_MS:
+            break
+        time.sleep(backoff)
+    return pending
+
+
+# Write undelivered records as one compressed JSON lines object to the dead-letter prefix.
+# The key uses the request id, so an async retry of this invocation overwrites its own spill.
+# Returns False if no spill bucket is configured.
+def SpillRecords(spilled, context):
+    spillBucket = os.environ.get('spill_bucket')
+    if not spillBucket:
+        print("No spill_bucket set, dropping undelivered records: " + str(len(spilled)))
+        return False
+    requestId = context.aws_request_id if context is not None else str(int(time.time() * 1000))
+    key = os.environ.get('spill_prefix', DEAD_LETTER_PREFIX) + \
+        datetime.datetime.utcnow().strftime('%Y/%m/%d/%H/') + requestId + '.json.gz'
+    body = '\n'.join(json.dumps(x) for x in spilled).encode()
+    s3_client.put_object(Bucket=spillBucket, Key=key, Body=gzip.compress(body))
+    print("Spilled undelivered records to s3://" + spillBucket + "/" + key + ": " + str(len(spilled)))
+    return True
+
+
+# Stable (not per process randomized) choice of delivery stream for a shard key
+def StreamForKey(streamNames, key):
+    return streamNames[zlib.crc32(key.encode()) % len(streamNames)]
+
+
+# Invocation spill metrics in CloudWatch embedded metric format, written to the Lambda log
+def PrintSpillMetrics(spilled, failed):
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': 'VPCFlowLogs',
+                'Dimensions': [[]],
+                'Metrics': [
+                    {'Name': 'SpilledRecords', 'Unit': 'Count'},
+                    {'Name': 'SpillFailedRecords', 'Unit': 'Count'},
+                ],
+            }],
+        },
+        'SpilledRecords': spilled,
+        'SpillFailedRecords': failed,
+    }))
+
+
+# Per shard metrics in CloudWatch embedded metric format, written to the Lambda log
+def PrintShardMetrics(streamName, records, size, failed):
+    print(json.dumps({
+        '_aws': {
+            'Timestamp': int(time.time() * 1000),
+            'CloudWatchMetrics': [{
+                'Namespace': 'VPCFlowLogs',
+                'Dimensions': [['DeliveryStreamName']],
+                'Metrics': [
+                    {'Name': 'ShardRecords', 'Unit': 'Count'},
+                    {'Name': 'ShardBytes', 'Unit': 'Bytes'},
+                    {'Name': 'ShardFailedRecords', 'Unit': 'Count'},
+                ],
+            }],
+        },
+        'DeliveryStreamName': streamName,
+        'ShardRecords': records,
+        'ShardBytes': size,
+        'ShardFailedRecords': failed,
+    }))
 
 
 def lambda_handler(event, context):
@@ -39,29 +151,64 @@ def lambda_handler(event, context):
     # convert the log data from JSON into a dictionary
     cleanEvent = json.loads(outEvent3)
     print(cleanEvent)
-    # initiate a list
-    s = []
-    # set the name of the Kinesis Firehose Stream
-    firehoseName = os.environ['firehose_stream']
+    # set the names of the Kinesis Firehose Streams, one list of records per stream
+    firehoseNames = os.environ.get('firehose_streams', os.environ.get('firehose_stream', '')).split(',')
+    shardKey = os.environ.get('shard_key', 'interface_id')
+    batches = dict((name, []) for name in firehoseNames)
+    batchIds = dict((name, []) for name in firehoseNames)
+    spilled = []
+    metrics = dict((name, [0, 0, 0]) for name in firehoseNames)
 
     """
     'logEvents': [{'id': '34556518727316219200749233816408550482522047377421172736', 'timestamp': 1549567892000, 'message': '2 671900666536 eni-3001219a 88.214.26.44 172.31.10.128 18606 4145 6 3 180 1549567892 1549567939 ACCEPT OK', 'extractedFields': {'srcaddr': '88.214.26.44', 'dstport': '4145', 'start': '1549567892', 'dstaddr': '172.31.10.128', 'version': '2', 'packets': '3', 'protocol': '6', 'account_id': '671900666536', 'interface_id': 'eni-3001219a', 'log_status': 'OK', 'bytes': '180', 'srcport': '18606', 'action': 'ACCEPT', 'end': '1549567939'}}
     """
 
     for line in cleanEvent['logEvents']:
-        record_json = json.dumps(line['extractedFields'])
+        fields = event_fields(line)
+        if fields is None:
+            continue
+        record_json = json.dumps(fields)
         current_record = {'Data': record_json.encode()}
+        if shardKey == 'log_group':
+            firehoseName = StreamForKey(firehoseNames, cleanEvent['logGroup'])
+        else:
+            firehoseName = StreamForKey(firehoseNames, fields.get('interface_id', ''))
+        s = batches[firehoseName]
         s.append(current_record)
+        batchIds[firehoseName].append(line['id'])
+        metrics[firehoseName][0] += 1
+        metrics[firehoseName][1] += len(current_record['Data'])
 
       # limit of 500 records per batch. Break it up if you have to.
         if len(s) > 499:
-            # send the response to Firehose in bulk
-            SendToFireHose(firehoseName, s)
+            # send the response to Firehose in bulk, keep what could not be delivered
+            failed = DeliverBatch(firehoseName, s, context)
+            spilled.extend({'id': batchIds[firehoseName][i], 'stream': firehoseName, 'data': s[i]['Data'].decode()}
+                           for i in failed)
+            metrics[firehoseName][2] += len(failed)
 
             # Empty the list
-            s = []
+            batches[firehoseName] = []
+            batchIds[firehoseName] = []
 
     # when done, send the response to Firehose in bulk
-    if len(s) > 0:
-        SendToFireHose(firehoseName, s)
+    for firehoseName, s in batches.items():
+        if len(s) > 0:
+            failed = DeliverBatch(firehoseName, s, context)
+            spilled.extend({'id': batchIds[firehoseName][i], 'stream': firehoseName, 'data': s[i]['Data'].decode()}
+                           for i in failed)
+            metrics[firehoseName][2] += len(failed)
+        if metrics[firehoseName][0] > 0:
+            PrintShardMetrics(firehoseName, *metrics[firehoseName])
+
+    # spill instead of failing the invocation, so Lambda does not retry the whole batch
+    if len(spilled) > 0:
+        try:
+            spillFailed = 0 if SpillRecords(spilled, context) else len(spilled)
+        except Exception as e:
+            # a retry of the whole batch would amplify the incident, count the loss instead
+            print("Spill failed, undelivered records lost: " + str(len(spilled)))
+            print(e)
+            spillFailed = len(spilled)
+        PrintSpillMetrics(len(spilled) - spillFailed, spillFailed)
     return
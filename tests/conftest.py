@@ -0,0 +1,14 @@
+import os
+import sys
+
+# the scripts live in the repository root, next to cloudwatch_build.py
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+class FakePaginator:
+    # stands in for a boto3 paginator, pages(**kwargs) returns the pages of one paginate call
+    def __init__(self, pages):
+        self.pages = pages
+
+    def paginate(self, **kwargs):
+        return iter(self.pages(**kwargs))
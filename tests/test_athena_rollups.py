@@ -0,0 +1,232 @@
+import datetime
+
+import pytest
+
+import athena_rollups
+from conftest import FakePaginator
+
+
+def hours(day, first, last):
+    return set(('2019', '02', day, '%02d' % h) for h in range(first, last + 1))
+
+
+def test_partition_filters_groups_hours_by_day():
+    filters = athena_rollups.partition_filters(
+        athena_rollups.SOURCE_PARTITIONS,
+        [('2019', '02', '08', '01'), ('2019', '02', '07', '23'), ('2019', '02', '08', '00')],
+    )
+    assert filters == [
+        "partition_0 = '2019' AND partition_1 = '02' AND partition_2 = '07' AND partition_3 IN ('23')",
+        "partition_0 = '2019' AND partition_1 = '02' AND partition_2 = '08' AND partition_3 IN ('00', '01')",
+    ]
+
+
+def test_pending_partitions_skips_unsettled_and_processed_hours():
+    source = hours('08', 0, 12)
+    pending = athena_rollups.pending_partitions(source, hours('08', 0, 9), now=datetime.datetime(2019, 2, 8, 12, 10))
+    # hour 11 ended at 12:00, but is still within the settle time
+    assert pending == [('2019', '02', '08', '10')]
+
+
+def test_pending_partitions_includes_settled_hours_without_data():
+    source = hours('08', 0, 0) | hours('08', 3, 3)
+    pending = athena_rollups.pending_partitions(source, set(), now=datetime.datetime(2019, 2, 8, 5))
+    assert pending == sorted(hours('08', 0, 3))
+
+
+def test_daily_pending_waits_for_all_24_hours():
+    # only 13 hours registered when the update runs after midnight
+    assert athena_rollups.daily_pending(dict.fromkeys(hours('07', 0, 12), 'done'), set()) == []
+    states = dict.fromkeys(hours('07', 0, 23), 'done')
+    states[('2019', '02', '07', '05')] = 'empty'
+    assert athena_rollups.daily_pending(states, set()) == sorted(hours('07', 0, 23) - hours('07', 5, 5))
+    # an hour rolled up after the day was folded is added to the day
+    states[('2019', '02', '07', '05')] = 'done'
+    assert athena_rollups.daily_pending(states, hours('07', 0, 23) - hours('07', 5, 5)) == [('2019', '02', '07', '05')]
+
+
+def test_render_query_validates_parameters():
+    sql = athena_rollups.render_query('top_talkers', '2019-02-01', '2019-02-07', '10')
+    assert "BETWEEN '20190201' AND '20190207'" in sql
+    assert sql.endswith('LIMIT 10')
+    with pytest.raises(Exception):
+        athena_rollups.render_query('unknown', '2019-02-01', '2019-02-07')
+    with pytest.raises(ValueError):
+        athena_rollups.render_query('top_talkers', "2019-02-01' OR 1=1", '2019-02-07')
+
+
+@pytest.fixture
+def lake(tmp_path):
+    duckdb = pytest.importorskip('duckdb')
+    connection = duckdb.connect()
+
+    def write_hour(day, hour, action='ACCEPT'):
+        path = tmp_path / 'lake' / 'partition_0=2019' / 'partition_1=02' / ('partition_2=' + day) / (
+            'partition_3=' + hour)
+        path.mkdir(parents=True)
+        connection.execute(
+            """COPY (SELECT 1549567892 AS start, 1549567939 AS "end", '10.0.0.' || (i % 3) AS srcaddr,
+                    '10.0.1.1' AS dstaddr, 1000 + i AS srcport, 22 AS dstport, 6 AS protocol, 3 AS packets,
+                    180 AS bytes, 'OK' AS logstatus, '{0}' AS action, 'eni-' || (i % 2) AS interface_id,
+                    '1234' AS account_id FROM range(10) t(i)) TO '{1}' (FORMAT parquet)""".format(
+                action, str(path / 'data.parquet')))
+
+    return tmp_path, write_hour
+
+
+def test_duckdb_update_is_incremental(lake):
+    tmp_path, write_hour = lake
+    for hour in range(24):
+        write_hour('07', '%02d' % hour, 'REJECT' if hour == 5 else 'ACCEPT')
+    write_hour('08', '00')
+    engine = athena_rollups.DuckDBEngine(str(tmp_path / 'lake'), str(tmp_path / 'rollups.db'))
+
+    added = athena_rollups.update_rollups(engine, now=datetime.datetime(2019, 2, 7, 12))
+    assert added['talkers_hourly'] == 11
+    assert added['talkers_daily'] == 0
+
+    added = athena_rollups.update_rollups(engine, now=datetime.datetime(2019, 2, 8, 2))
+    assert added['talkers_hourly'] == 14
+    assert added['rejects_hourly'] == 14
+    assert added['talkers_daily'] == 24
+
+    # hours without REJECT rows are processed once and not scanned again
+    added = athena_rollups.update_rollups(engine, now=datetime.datetime(2019, 2, 8, 2))
+    assert set(added.values()) == {0}
+
+    columns, rows = athena_rollups.run_query(engine, 'top_talkers', '2019-02-07', '2019-02-07', 1)
+    assert rows == [('10.0.0.0', '10.0.1.1', str(24 * 4 * 180), str(24 * 4 * 3), str(24 * 4))]
+    columns, rows = athena_rollups.run_query(engine, 'rejected_by_port', '2019-02-07', '2019-02-07')
+    assert rows == [('22', '6', '10', '30')]
+
+
+def test_duckdb_update_does_not_insert_twice_after_failure(lake):
+    tmp_path, write_hour = lake
+    for hour in range(24):
+        write_hour('07', '%02d' % hour)
+    write_hour('08', '00')
+    engine = athena_rollups.DuckDBEngine(str(tmp_path / 'lake'), str(tmp_path / 'rollups.db'))
+    execute = engine.execute
+    inserts = []
+
+    def failing_execute(sql):
+        if sql.startswith('INSERT INTO "talkers_hourly"'):
+            inserts.append(sql)
+            if len(inserts) == 2:
+                raise Exception('Query exhausted resources')
+        return execute(sql)
+
+    engine.execute = failing_execute
+    with pytest.raises(Exception):
+        athena_rollups.update_rollups(engine, now=datetime.datetime(2019, 2, 8, 2))
+    engine.execute = execute
+    added = athena_rollups.update_rollups(engine, now=datetime.datetime(2019, 2, 8, 2))
+    assert added['talkers_hourly'] == 1
+
+    columns, rows = engine.execute('SELECT COUNT(*) FROM (SELECT year, month, day, hour, srcaddr, dstaddr '
+                                   'FROM talkers_hourly GROUP BY ALL HAVING COUNT(*) > 1)')
+    assert rows == [('0',)]
+    columns, rows = athena_rollups.run_query(engine, 'top_talkers', '2019-02-07', '2019-02-07', 1)
+    assert rows == [('10.0.0.0', '10.0.1.1', str(24 * 4 * 180), str(24 * 4 * 3), str(24 * 4))]
+
+
+def talkers_hours(engine):
+    columns, rows = engine.execute('SELECT DISTINCT day, hour FROM talkers_hourly ORDER BY day, hour')
+    return rows
+
+
+def test_duckdb_update_rolls_up_hours_registered_late(lake):
+    tmp_path, write_hour = lake
+    write_hour('07', '00')
+    write_hour('07', '03')
+    engine = athena_rollups.DuckDBEngine(str(tmp_path / 'lake'), str(tmp_path / 'rollups.db'))
+    added = athena_rollups.update_rollups(engine, now=datetime.datetime(2019, 2, 7, 5))
+    assert added['talkers_hourly'] == 2
+
+    # hours without data are re-checked until they are older than the register lookback
+    write_hour('07', '02')
+    athena_rollups.update_rollups(engine, now=datetime.datetime(2019, 2, 7, 6))
+    assert talkers_hours(engine) == [('07', '00'), ('07', '02'), ('07', '03')]
+    added = athena_rollups.update_rollups(engine, now=datetime.datetime(2019, 2, 10))
+    assert added['talkers_daily'] == 3
+    assert athena_rollups.processed_partitions(engine)['talkers_hourly'][('2019', '02', '07', '01')] == 'empty'
+
+    # a backfilled hour recorded as empty is still rolled up and added to the day
+    write_hour('07', '01')
+    added = athena_rollups.update_rollups(engine, now=datetime.datetime(2019, 2, 10, 1))
+    assert added['talkers_hourly'] == 1
+    assert added['talkers_daily'] == 1
+    columns, rows = athena_rollups.run_query(engine, 'top_talkers', '2019-02-07', '2019-02-07', 1)
+    assert rows[0][4] == str(4 * 4)
+
+
+def test_duckdb_reprocess_rebuilds_backfilled_days(lake):
+    tmp_path, write_hour = lake
+    for hour in range(24):
+        write_hour('07', '%02d' % hour)
+    engine = athena_rollups.DuckDBEngine(str(tmp_path / 'lake'), str(tmp_path / 'rollups.db'))
+    athena_rollups.update_rollups(engine, now=datetime.datetime(2019, 2, 8, 2))
+
+    # backfill writes more rows into an hour that was already rolled up
+    duckdb = pytest.importorskip('duckdb')
+    duckdb.connect().execute("COPY (SELECT * FROM read_parquet('{0}')) TO '{1}' (FORMAT parquet)".format(
+        str(tmp_path / 'lake' / 'partition_0=2019' / 'partition_1=02' / 'partition_2=07' / 'partition_3=05' /
+            'data.parquet'),
+        str(tmp_path / 'lake' / 'partition_0=2019' / 'partition_1=02' / 'partition_2=07' / 'partition_3=05' /
+            'backfill.parquet')))
+    reset = athena_rollups.reprocess_rollups(engine, '2019-02-07', '2019-02-07')
+    assert reset == {'talkers_hourly': 24, 'rejects_hourly': 24, 'eni_bytes_hourly': 24,
+                     'talkers_daily': 24, 'rejects_daily': 24}
+    added = athena_rollups.update_rollups(engine, now=datetime.datetime(2019, 2, 8, 2))
+    assert added['talkers_hourly'] == 24
+    columns, rows = athena_rollups.run_query(engine, 'top_talkers', '2019-02-07', '2019-02-07', 1)
+    assert rows[0][4] == str(25 * 4)
+
+
+class FakeAws:
+    # stands in for the athena, glue and s3 clients used by AthenaEngine.register_partitions
+    def __init__(self):
+        self.queries = []
+        self.deleted = []
+
+    def get_paginator(self, operation_name):
+        if operation_name == 'get_partitions':
+            return FakePaginator(lambda **kwargs: [{'Partitions': [{'Values': ['2019', '02', '08', '00']}]}])
+        if operation_name == 'list_objects_v2':
+            return FakePaginator(self.list_objects)
+        return FakePaginator(lambda **kwargs: [{'ResultSet': {'ResultSetMetadata': {'ColumnInfo': []}, 'Rows': []}}])
+
+    def list_objects(self, Prefix, **kwargs):
+        if Prefix.startswith('rollups/'):
+            return [{'Contents': [{'Key': Prefix + 'part-0.parquet'}]}]
+        if Prefix == '2019/02/08/':
+            return [{'CommonPrefixes': [{'Prefix': Prefix + '00/'}, {'Prefix': Prefix + '01/'}]}]
+        return [{}]
+
+    def delete_objects(self, Bucket, Delete):
+        self.deleted.extend(x['Key'] for x in Delete['Objects'])
+
+    def start_query_execution(self, QueryString, **kwargs):
+        self.queries.append(QueryString)
+        return {'QueryExecutionId': str(len(self.queries))}
+
+    def get_query_execution(self, QueryExecutionId):
+        return {'QueryExecution': {'Status': {'State': 'SUCCEEDED'}}}
+
+
+def test_athena_register_partitions_adds_new_firehose_prefixes():
+    aws = FakeAws()
+    engine = athena_rollups.AthenaEngine(aws, aws, aws, 'db', 'vpc_flowlogs_parquet_x', 'bucket')
+    assert engine.register_partitions(datetime.datetime(2019, 2, 8, 3)) == 1
+    assert aws.queries == [
+        "ALTER TABLE `vpc_flowlogs_parquet_x` ADD IF NOT EXISTS\n"
+        "PARTITION (partition_0 = '2019', partition_1 = '02', partition_2 = '08', partition_3 = '01') "
+        "LOCATION 's3://bucket/2019/02/08/01/'"
+    ]
+
+
+def test_athena_delete_partitions_removes_rollup_files():
+    aws = FakeAws()
+    engine = athena_rollups.AthenaEngine(aws, aws, aws, 'db', 'vpc_flowlogs_parquet_x', 'bucket')
+    engine.delete_partitions('talkers_hourly', athena_rollups.DAILY_PARTITIONS, [('2019', '02', '07')])
+    assert aws.deleted == ['rollups/talkers_hourly/year=2019/month=02/day=07/part-0.parquet']
@@ -0,0 +1,185 @@
+import base64
+import gzip
+import json
+import os
+
+import pytest
+
+import firehose_shards
+
+STREAM_CONFIGURATION = {
+    'RoleARN': 'arn:aws:iam::123456789012:role/firehose',
+    'BucketARN': 'arn:aws:s3:::bucket',
+    'BufferingHints': {'SizeInMBs': 128, 'IntervalInSeconds': 300},
+    'S3BackupMode': 'Disabled',
+}
+
+
+class FakeCloudWatch:
+    # stands in for the CloudWatch client, datapoints maps (stream, metric) to {timestamp: value}
+    def __init__(self, datapoints):
+        self.datapoints = datapoints
+        self.periods = set()
+
+    def get_metric_statistics(self, Namespace, MetricName, Dimensions, StartTime, EndTime, Period, Statistics):
+        self.periods.add(Period)
+        values = self.datapoints.get((Dimensions[0]['Value'], MetricName), {})
+        return {'Datapoints': [{'Timestamp': x, Statistics[0]: y} for x, y in values.items()]}
+
+
+class FakeFirehose:
+    def __init__(self):
+        self.created = []
+
+    def describe_delivery_stream(self, DeliveryStreamName):
+        return {'DeliveryStreamDescription': {
+            'DeliveryStreamStatus': 'ACTIVE',
+            'Destinations': [{'ExtendedS3DestinationDescription': STREAM_CONFIGURATION}],
+        }}
+
+    def create_delivery_stream(self, DeliveryStreamName, ExtendedS3DestinationConfiguration):
+        self.created.append((DeliveryStreamName, ExtendedS3DestinationConfiguration))
+
+
+class FakeLambda:
+    def __init__(self, variables):
+        self.variables = variables
+        self.updates = []
+
+    def get_function_configuration(self, FunctionName):
+        return {'Environment': {'Variables': dict(self.variables)}}
+
+    def update_function_configuration(self, FunctionName, Environment):
+        self.updates.append(Environment['Variables'])
+        self.variables = Environment['Variables']
+
+
+def test_metric_period_fits_datapoint_limit():
+    assert firehose_shards.metric_period(1) == 60
+    assert firehose_shards.metric_period(24) == 60
+    assert firehose_shards.metric_period(25) == 120
+    assert firehose_shards.metric_period(24 * 14) == 840
+    for hours in (1, 24, 25, 48, 24 * 14):
+        assert hours * 3600 / firehose_shards.metric_period(hours) <= firehose_shards.MAX_DATAPOINTS
+
+
+def test_recommend_shards_sums_streams_per_period():
+    # both streams peak at 600 records/sec in the same minute, limit 1000 records/sec per stream
+    cloudwatch = FakeCloudWatch({
+        ('s-0', 'IncomingRecords'): {1: 36000, 2: 6000},
+        ('s-1', 'IncomingRecords'): {1: 36000, 3: 60000},
+        ('s-0', 'RecordsPerSecondLimit'): {1: 1000},
+    })
+    shards, details = firehose_shards.recommend_shards(cloudwatch, ['s-0', 's-1'], 'eu-central-1', 24)
+    assert cloudwatch.periods == {60}
+    assert details['peak_records_per_second'] == 1200
+    assert details['records_limit'] == 1000
+    assert details['bytes_limit'] == firehose_shards.DEFAULT_LIMITS['bytes']
+    assert shards == 2
+
+
+def test_recommend_shards_adds_shard_when_throttled():
+    cloudwatch = FakeCloudWatch({('s-0', 'ThrottledRecords'): {1: 5}})
+    shards, details = firehose_shards.recommend_shards(cloudwatch, ['s-0'], 'us-east-1', 48)
+    assert cloudwatch.periods == {120}
+    assert details['throttled_records'] == 5
+    assert shards == 2
+
+
+def test_add_shards_names_streams_after_first():
+    firehose = FakeFirehose()
+    lambda_client = FakeLambda({'firehose_streams': 'flowlogs-0,flowlogs-1', 'spill_bucket': 'bucket'})
+    names = firehose_shards.add_shards(firehose, lambda_client, 'transform', 4)
+    assert names == ['flowlogs-0', 'flowlogs-1', 'flowlogs-2', 'flowlogs-3']
+    assert [x[0] for x in firehose.created] == ['flowlogs-2', 'flowlogs-3']
+    # only destination settings are copied from the first stream
+    assert 'S3BackupMode' not in firehose.created[0][1]
+    assert firehose.created[0][1]['BufferingHints'] == STREAM_CONFIGURATION['BufferingHints']
+    assert lambda_client.updates == [
+        {'firehose_streams': 'flowlogs-0,flowlogs-1,flowlogs-2,flowlogs-3', 'spill_bucket': 'bucket'}]
+
+
+def test_add_shards_to_single_stream_build():
+    firehose = FakeFirehose()
+    lambda_client = FakeLambda({'firehose_stream': 'flowlogs'})
+    assert firehose_shards.add_shards(firehose, lambda_client, 'transform', 2) == ['flowlogs', 'flowlogs-1']
+    assert lambda_client.variables['firehose_streams'] == 'flowlogs,flowlogs-1'
+
+    # nothing to add
+    assert firehose_shards.add_shards(firehose, lambda_client, 'transform', 2) == ['flowlogs', 'flowlogs-1']
+    assert len(firehose.created) == 1
+    assert len(lambda_client.updates) == 1
+
+
+class RecordingFirehose:
+    def __init__(self):
+        self.delivered = {}
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        self.delivered.setdefault(DeliveryStreamName, []).extend(Records)
+        return {'FailedPutCount': 0, 'RequestResponses': [{'RecordId': '1'} for x in Records]}
+
+
+class Context:
+    aws_request_id = 'request-1'
+
+    def get_remaining_time_in_millis(self):
+        return 20000
+
+
+def cloudwatch_event(count, interfaces):
+    data = {'logGroup': 'group', 'logEvents': [
+        {'id': str(i), 'timestamp': 1549567892000,
+         'message': '2 671900666536 eni-%d 88.214.26.44 172.31.10.128 18606 4145 6 3 180 1549567892 1549567939 '
+                    'ACCEPT OK' % (i % interfaces)}
+        for i in range(count)]}
+    return {'awslogs': {'data': base64.b64encode(gzip.compress(json.dumps(data).encode())).decode()}}
+
+
+@pytest.fixture
+def transform(monkeypatch):
+    pytest.importorskip('boto3')
+    os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+    import lambda_flowlogs_transform_kinesis
+    firehose = RecordingFirehose()
+    monkeypatch.setattr(lambda_flowlogs_transform_kinesis, 'firehose_client', firehose)
+    monkeypatch.setenv('firehose_streams', 's-0,s-1,s-2')
+    return lambda_flowlogs_transform_kinesis, firehose
+
+
+def shard_metrics(output):
+    metrics = [json.loads(x) for x in output.splitlines() if x.startswith('{"_aws"')]
+    return dict((x['DeliveryStreamName'], x) for x in metrics if 'ShardRecords' in x)
+
+
+def test_stream_for_key_is_stable_and_uses_all_streams(transform):
+    module, firehose = transform
+    names = ['s-0', 's-1', 's-2']
+    keys = ['eni-%d' % i for i in range(100)]
+    assert [module.StreamForKey(names, x) for x in keys] == [module.StreamForKey(list(names), x) for x in keys]
+    assert set(module.StreamForKey(names, x) for x in keys) == set(names)
+
+
+def test_records_are_routed_by_interface_with_shard_metrics(transform, capsys):
+    module, firehose = transform
+    module.lambda_handler(cloudwatch_event(60, 6), Context())
+    assert sum(len(x) for x in firehose.delivered.values()) == 60
+    for name, records in firehose.delivered.items():
+        interfaces = set(json.loads(x['Data'])['interface_id'] for x in records)
+        assert all(module.StreamForKey(['s-0', 's-1', 's-2'], x) == name for x in interfaces)
+    metrics = shard_metrics(capsys.readouterr().out)
+    assert sorted(metrics) == sorted(firehose.delivered)
+    for name, records in firehose.delivered.items():
+        assert metrics[name]['ShardRecords'] == len(records)
+        assert metrics[name]['ShardBytes'] == sum(len(x['Data']) for x in records)
+        assert metrics[name]['ShardFailedRecords'] == 0
+        assert metrics[name]['_aws']['CloudWatchMetrics'][0]['Dimensions'] == [['DeliveryStreamName']]
+
+
+def test_records_are_routed_by_log_group(transform, monkeypatch, capsys):
+    module, firehose = transform
+    monkeypatch.setenv('shard_key', 'log_group')
+    module.lambda_handler(cloudwatch_event(60, 6), Context())
+    assert list(firehose.delivered) == [module.StreamForKey(['s-0', 's-1', 's-2'], 'group')]
+    assert len(firehose.delivered[module.StreamForKey(['s-0', 's-1', 's-2'], 'group')]) == 60
+    assert list(shard_metrics(capsys.readouterr().out)) == list(firehose.delivered)
@@ -0,0 +1,124 @@
+import pytest
+
+import flowlogs_backfill
+from conftest import FakePaginator
+
+START = flowlogs_backfill.to_epoch_ms('2019-02-07')
+END = flowlogs_backfill.to_epoch_ms('2019-02-09')
+HOUR = flowlogs_backfill.HOUR_MS
+INGESTION_DELAY = 10 * 60 * 1000
+MESSAGE = '2 671900666536 eni-3001219a 88.214.26.44 172.31.10.128 18606 4145 6 3 180 1549567892 1549567939 ACCEPT OK'
+
+
+class FakeLogs:
+    # stands in for the CloudWatch Logs client: one flow log record every 30 minutes per stream,
+    # ingested 10 minutes after its timestamp
+    def __init__(self, streams, subscription_created=None, failing_stream=None):
+        self.streams = streams
+        self.subscription_created = subscription_created
+        self.failing_stream = failing_stream
+        self.calls = []
+
+    def describe_subscription_filters(self, logGroupName):
+        if self.subscription_created is None:
+            return {'subscriptionFilters': []}
+        return {'subscriptionFilters': [{'creationTime': self.subscription_created}]}
+
+    def get_paginator(self, operation_name):
+        if operation_name == 'describe_log_streams':
+            return FakePaginator(lambda **kwargs: [{'logStreams': self.streams}])
+        return FakePaginator(self.filter_log_events)
+
+    def filter_log_events(self, logGroupName, logStreamNames, startTime, endTime):
+        self.calls.append((logStreamNames[0], startTime, endTime))
+        if logStreamNames[0] == self.failing_stream:
+            raise Exception('ThrottlingException')
+        timestamp = startTime
+        while timestamp <= endTime:
+            yield {'events': [
+                {'id': str(timestamp), 'timestamp': timestamp, 'ingestionTime': timestamp + INGESTION_DELAY,
+                 'message': MESSAGE},
+                {'id': str(timestamp) + 'n', 'timestamp': timestamp, 'ingestionTime': timestamp + INGESTION_DELAY,
+                 'message': '2 1 eni-1 - - - - - - - 1 2 - NODATA'},
+            ]}
+            timestamp += HOUR // 2
+
+
+def stream(name, first, last):
+    return {'logStreamName': name, 'firstEventTimestamp': first, 'lastEventTimestamp': last}
+
+
+def test_make_shards_clips_windows_to_stream_events():
+    streams = [('eni-a', START, END), ('eni-b', START + 13 * HOUR, START + 14 * HOUR), ('eni-c', END + HOUR, END + HOUR)]
+    shards = flowlogs_backfill.make_shards(streams, START, END, 6)
+    assert [x[1:] for x in shards if x[1] == 'eni-b'] == [('eni-b', START + 12 * HOUR, START + 18 * HOUR)]
+    assert len([x for x in shards if x[1] == 'eni-a']) == 8
+    assert not [x for x in shards if x[1] == 'eni-c']
+
+
+def test_list_log_streams_skips_streams_outside_range():
+    logs = FakeLogs([stream('eni-a', START, END), stream('old', 0, START - 1)])
+    assert flowlogs_backfill.list_log_streams(logs, 'group', START, END) == [('eni-a', START, END)]
+
+
+def test_checkpoint_appends_completed_shards(tmp_path):
+    path = str(tmp_path / 'checkpoint')
+    checkpoint = flowlogs_backfill.Checkpoint(path)
+    checkpoint.start('window_hours=6')
+    checkpoint.complete('a|1|2')
+    checkpoint.complete('b|1|2')
+    assert open(path).read() == '# window_hours=6\na|1|2\nb|1|2\n'
+    checkpoint = flowlogs_backfill.Checkpoint(path)
+    checkpoint.start('window_hours=6')
+    assert checkpoint.done('b|1|2')
+    assert not checkpoint.done('# window_hours=6')
+
+
+def test_run_backfill_refuses_checkpoint_of_other_window(tmp_path):
+    path = str(tmp_path / 'checkpoint')
+    logs = FakeLogs([stream('eni-a', START, END)])
+    flowlogs_backfill.Checkpoint(path).start('start={0} end={1} window_hours=6'.format(START, END))
+    with pytest.raises(Exception):
+        flowlogs_backfill.run_backfill(logs, {}.__setitem__, 'group', START, END,
+                                       flowlogs_backfill.Checkpoint(path), 12, 2)
+    assert logs.calls == []
+
+
+def test_run_backfill_resumes_from_checkpoint(tmp_path):
+    pytest.importorskip('pyarrow')
+    objects = {}
+    path = str(tmp_path / 'checkpoint')
+    logs = FakeLogs([stream('eni-a', START, END), stream('eni-b', START, END)], failing_stream='eni-b')
+
+    stats = flowlogs_backfill.run_backfill(logs, objects.__setitem__, 'group', START, END,
+                                           flowlogs_backfill.Checkpoint(path), 12, 4)
+    assert stats == {'shards': 4, 'skipped': 0, 'failed': 4, 'records': 4 * 24}
+    assert len(objects) == 48
+
+    logs.failing_stream = None
+    logs.calls = []
+    stats = flowlogs_backfill.run_backfill(logs, objects.__setitem__, 'group', START, END,
+                                           flowlogs_backfill.Checkpoint(path), 12, 4)
+    assert stats == {'shards': 4, 'skipped': 4, 'failed': 0, 'records': 4 * 24}
+    assert set(x[0] for x in logs.calls) == {'eni-b'}
+    assert len(objects) == 96
+    assert sorted(objects)[0].startswith('2019/02/07/00/backfill-')
+
+
+def test_run_backfill_stops_at_subscription_filter(tmp_path):
+    pytest.importorskip('pyarrow')
+    objects = {}
+    logs = FakeLogs([stream('eni-a', START, END)], subscription_created=START + 30 * HOUR)
+    stats = flowlogs_backfill.run_backfill(logs, objects.__setitem__, 'group', START, END,
+                                           flowlogs_backfill.Checkpoint(None), 12, 2)
+    assert stats['records'] == 60
+    assert max(x[2] for x in logs.calls) < START + 30 * HOUR
+
+
+def test_read_shard_skips_events_ingested_after_subscription():
+    logs = FakeLogs([])
+    created = START + HOUR + 5 * 60 * 1000
+    partitions = flowlogs_backfill.read_shard(logs, 'group', 'eni-a', START, START + 2 * HOUR, created)
+    # 01:00 has a timestamp before the subscription filter, but was ingested after it
+    assert sum(len(x) for x in partitions.values()) == 2
+    assert list(partitions) == ['2019/02/07/00/']
@@ -0,0 +1,126 @@
+import base64
+import gzip
+import json
+import os
+
+import pytest
+
+import flowlogs_replay
+
+pytest.importorskip('boto3')
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+import lambda_flowlogs_transform_kinesis  # noqa: E402
+
+
+class FakeFirehose:
+    # stands in for the Firehose client, rejecting the records for which reject(data) is true
+    def __init__(self, reject):
+        self.reject = reject
+        self.delivered = []
+
+    def put_record_batch(self, DeliveryStreamName, Records):
+        responses = []
+        for record in Records:
+            if self.reject(record['Data']):
+                responses.append({'ErrorCode': 'ServiceUnavailableException', 'ErrorMessage': 'Slow down.'})
+            else:
+                self.delivered.append((DeliveryStreamName, record['Data']))
+                responses.append({'RecordId': str(len(self.delivered))})
+        return {'FailedPutCount': sum('ErrorCode' in x for x in responses), 'RequestResponses': responses}
+
+
+class FailingObjectStore:
+    def put_object(self, Bucket, Key, Body):
+        raise Exception('SlowDown')
+
+
+class Context:
+    def __init__(self, request_id, remaining_ms=20000):
+        self.aws_request_id = request_id
+        self.remaining_ms = remaining_ms
+
+    def get_remaining_time_in_millis(self):
+        return self.remaining_ms
+
+
+def cloudwatch_event(count):
+    data = {'logGroup': 'group', 'logEvents': [
+        {'id': str(i), 'timestamp': 1549567892000,
+         'message': '2 671900666536 eni-%d 88.214.26.44 172.31.10.128 18606 4145 6 3 180 1549567892 1549567939 '
+                    'ACCEPT OK' % (i % 7)}
+        for i in range(count)]}
+    return {'awslogs': {'data': base64.b64encode(gzip.compress(json.dumps(data).encode())).decode()}}
+
+
+@pytest.fixture
+def handler(tmp_path, monkeypatch):
+    store = flowlogs_replay.LocalObjectStore(str(tmp_path))
+    monkeypatch.setattr(lambda_flowlogs_transform_kinesis, 's3_client', store)
+    monkeypatch.setattr(lambda_flowlogs_transform_kinesis.time, 'sleep', lambda seconds: None)
+    monkeypatch.setenv('firehose_streams', 'stream-0,stream-1')
+    monkeypatch.setenv('spill_bucket', 'bucket')
+    return store
+
+
+def test_rejected_records_are_spilled_and_replayed_once(handler, tmp_path, monkeypatch):
+    firehose = FakeFirehose(lambda data: b'eni-3' in data)
+    monkeypatch.setattr(lambda_flowlogs_transform_kinesis, 'firehose_client', firehose)
+    event = cloudwatch_event(700)
+    lambda_flowlogs_transform_kinesis.lambda_handler(event, Context('request-1'))
+    assert len(firehose.delivered) == 600
+    # the same log events spilled again by another invocation
+    lambda_flowlogs_transform_kinesis.lambda_handler(event, Context('request-2'))
+    keys = flowlogs_replay.list_spill_objects(handler, 'bucket', flowlogs_replay.DEAD_LETTER_PREFIX)
+    assert len(keys) == 2
+    assert len(flowlogs_replay.read_spill_object(handler, 'bucket', keys[0])) == 100
+
+    monkeypatch.setattr(flowlogs_replay.time, 'sleep', lambda seconds: None)
+    replay_firehose = FakeFirehose(lambda data: False)
+    ledger = flowlogs_replay.Ledger(str(tmp_path / 'ledger'))
+    stats = flowlogs_replay.replay(handler, replay_firehose, 'bucket', ledger, rate=1e9)
+    assert stats == {'objects': 2, 'records': 100, 'duplicates': 100, 'failed': False}
+    assert all(b'eni-3' in data for stream, data in replay_firehose.delivered)
+    assert flowlogs_replay.list_spill_objects(handler, 'bucket', flowlogs_replay.DEAD_LETTER_PREFIX) == []
+    assert len(open(str(tmp_path / 'ledger')).read().split()) == 100
+
+
+def test_records_left_near_timeout_are_spilled(handler, monkeypatch):
+    firehose = FakeFirehose(lambda data: False)
+    monkeypatch.setattr(lambda_flowlogs_transform_kinesis, 'firehose_client', firehose)
+    lambda_flowlogs_transform_kinesis.lambda_handler(cloudwatch_event(20), Context('request-1', 1000))
+    assert firehose.delivered == []
+    keys = flowlogs_replay.list_spill_objects(handler, 'bucket', flowlogs_replay.DEAD_LETTER_PREFIX)
+    assert len(flowlogs_replay.read_spill_object(handler, 'bucket', keys[0])) == 20
+
+
+def test_failed_spill_does_not_fail_invocation(handler, monkeypatch, capsys):
+    monkeypatch.setattr(lambda_flowlogs_transform_kinesis, 'firehose_client', FakeFirehose(lambda data: True))
+    monkeypatch.setattr(lambda_flowlogs_transform_kinesis, 's3_client', FailingObjectStore())
+    lambda_flowlogs_transform_kinesis.lambda_handler(cloudwatch_event(10), Context('request-1'))
+    assert '"SpillFailedRecords": 10' in capsys.readouterr().out
+
+
+def test_replay_stops_and_keeps_object_when_delivery_fails(handler, tmp_path, monkeypatch):
+    monkeypatch.setattr(lambda_flowlogs_transform_kinesis, 'firehose_client', FakeFirehose(lambda data: True))
+    lambda_flowlogs_transform_kinesis.lambda_handler(cloudwatch_event(10), Context('request-1'))
+    monkeypatch.setattr(flowlogs_replay.time, 'sleep', lambda seconds: None)
+    stats = flowlogs_replay.replay(handler, FakeFirehose(lambda data: True), 'bucket',
+                                   flowlogs_replay.Ledger(None), rate=1e9)
+    assert stats['failed']
+    assert len(flowlogs_replay.list_spill_objects(handler, 'bucket', flowlogs_replay.DEAD_LETTER_PREFIX)) == 1
+
+
+def test_partly_delivered_batch_is_not_sent_again(handler, tmp_path, monkeypatch):
+    monkeypatch.setattr(lambda_flowlogs_transform_kinesis, 'firehose_client', FakeFirehose(lambda data: True))
+    lambda_flowlogs_transform_kinesis.lambda_handler(cloudwatch_event(10), Context('request-1'))
+    monkeypatch.setattr(flowlogs_replay.time, 'sleep', lambda seconds: None)
+    ledger_file = str(tmp_path / 'ledger')
+    firehose = FakeFirehose(lambda data: b'eni-3' in data)
+    stats = flowlogs_replay.replay(handler, firehose, 'bucket', flowlogs_replay.Ledger(ledger_file), rate=1e9)
+    # stream-0 holds the rejected record, its other records are delivered before replay stops
+    assert stats['failed'] and stats['records'] == 6
+
+    firehose.reject = lambda data: False
+    stats = flowlogs_replay.replay(handler, firehose, 'bucket', flowlogs_replay.Ledger(ledger_file), rate=1e9)
+    assert stats == {'objects': 1, 'records': 4, 'duplicates': 6, 'failed': False}
+    assert len(firehose.delivered) == 10